@@ -0,0 +1,148 @@
+"""
+Compare the relay modes of the proxy on the local machine.
+
+An echo server is started as fake service, then for each relay mode a proxy
+process is started in front of it and hammered by concurrent clients doing
+request/response round trips. Run it from the proxy folder:
+
+    python3 benchmark.py --connections 500 --requests 20
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import socketserver
+import threading
+import time
+from multiprocessing import Process, Value
+import src.filter_modules as modules
+import src.service_process as service_process
+import src.constants as constants
+from src.classes import Service, RELAY_MODES
+
+BENCHMARK_SERVICE = "benchmark"
+
+
+class EchoHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                break
+            self.request.sendall(data)
+
+
+class EchoServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_port(port, timeout=10):
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    raise TimeoutError(f"proxy not listening on port {port}")
+
+
+async def client(port, requests, payload, latencies):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for _ in range(requests):
+        start = time.perf_counter()
+        writer.write(payload)
+        await writer.drain()
+        received = 0
+        while received < len(payload):
+            data = await reader.read(65536)
+            if not data:
+                raise ConnectionError("connection closed by the proxy")
+            received += len(data)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def run_clients(port, connections, requests, payload):
+    latencies = []
+    start = time.perf_counter()
+    results = await asyncio.gather(*[client(port, requests, payload, latencies) for _ in range(connections)],
+                                   return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    errors = sum(isinstance(result, Exception) for result in results)
+    return latencies, elapsed, errors
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def benchmark(mode, target_port, args):
+    listen_port = free_port()
+    service = Service(BENCHMARK_SERVICE, "127.0.0.1", target_port, listen_port,
+                      listen_ip="127.0.0.1", relay=mode)
+    global_config = {
+        "keyword": "BENCHMARK",
+        "verbose": False,
+        "dos": {"enabled": False},
+        "max_stored_messages": 10,
+        "max_message_size": 65535
+    }
+    process = Process(target=service_process.service_function, args=(service, global_config, Value('i', 0)))
+    process.start()
+    try:
+        wait_port(listen_port)
+        latencies, elapsed, errors = asyncio.run(
+            run_clients(listen_port, args.connections, args.requests, b"A" * args.size))
+    finally:
+        process.terminate()
+        process.join()
+
+    latencies.sort()
+    print(f"{mode:>8}: {len(latencies) / elapsed:10.0f} req/s  "
+          f"p50 {percentile(latencies, 0.50) * 1000:8.2f} ms  "
+          f"p99 {percentile(latencies, 0.99) * 1000:8.2f} ms  "
+          f"max {latencies[-1] * 1000 if latencies else float('nan'):8.2f} ms  "
+          f"failed connections {errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the proxy relay modes")
+    parser.add_argument("--connections", type=int, default=200, help="concurrent client connections")
+    parser.add_argument("--requests", type=int, default=20, help="round trips per connection")
+    parser.add_argument("--size", type=int, default=512, help="payload size in bytes")
+    parser.add_argument("--modes", nargs="+", default=list(RELAY_MODES), choices=RELAY_MODES)
+    args = parser.parse_args()
+
+    # the module folder of the benchmark service is removed at the end, unless it was already there
+    modules_folder = os.path.join(constants.MODULES_PATH, BENCHMARK_SERVICE)
+    created = not os.path.isdir(modules_folder)
+    modules.generate_module_files([BENCHMARK_SERVICE], constants.MODULES_PATH)
+
+    target_port = free_port()
+    echo_server = EchoServer(("127.0.0.1", target_port), EchoHandler)
+    threading.Thread(target=echo_server.serve_forever, daemon=True).start()
+
+    print(f"{args.connections} connections x {args.requests} requests of {args.size} bytes")
+    try:
+        for mode in args.modes:
+            benchmark(mode, target_port, args)
+    finally:
+        echo_server.shutdown()
+        if created:
+            shutil.rmtree(modules_folder, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
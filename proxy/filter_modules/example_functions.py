@@ -1,6 +1,7 @@
 from src.stream import Stream, TCPStream, HTTPStream
 from src.db_manager import DBManager
-import string
+from src.state import StateStore
+from src.signatures import SignatureSet
 
 ################################################################################
 # HTTP
@@ -37,6 +38,13 @@ def replace_word(self, stream: HTTPStream):
     stream.current_message = stream.current_message.replace(b"leet", b"l33t")
     return False    # do not block message, just change its contents
 
+def giftCardState(self, stream: HTTPStream):
+    """block gift cards used twice, without a database round trip"""
+    message = stream.current_http_message
+    if "GET" in message.method and "card" in message.parameters:
+        return StateStore().seen_before(f"card:{message.parameters.get('card')}")
+    return False
+
 def giftCard(self, stream:HTTPStream):
     message = stream.current_http_message
 
@@ -55,9 +63,20 @@ def giftCard(self, stream:HTTPStream):
 ################################################################################
 # TCP
 
+# built once every time the module is (re)loaded, define it outside the Module class
+SIGNATURES = SignatureSet({
+    "path_traversal": b"../",
+    "sqli": b"' or 1=1",
+    "shell": b"/bin/sh",
+}, ignore_case=True)
+
+def signatures(self, stream: TCPStream):
+    """block packets containing a known payload, the attack name is the signature name"""
+    return SIGNATURES.search(stream.current_message)
+
 def nonPrintableChars(self, stream: TCPStream):
     """block packets with non printable chars"""
-    return any([chr(c) not in string.printable for c in stream.current_message])
+    return stream.features.non_printable > 0
 
 def password(self, stream:TCPStream):
     """block passwords longer than 10 characters"""
@@ -2,7 +2,10 @@ from src.stream import Stream, TCPStream, HTTPStream
 # from src.db_manager import DBManager
 
 class Module():
-    
+
+    # names of the functions that must not be used as filters
+    ignored_functions = [] # ["password"]
+
     # INFO: uncomment these functions to enable them
 
     # HTTP Example
@@ -34,11 +37,12 @@ class Module():
         Returns a string that identifies the attack name.
         If None is returned, no attack has been identified inside data.
         If a string is returned, an attack has been identified and the socket will be closed.
+
+        Note: the proxy doesn't call this method, it collects the filters once
+        when the module is (re)loaded and runs them in the same order.
         """
         
-        ignored_functions = [] # ["password"]
-        
-        attacks = [getattr(Module, attribute) for attribute in dir(Module) if callable(getattr(Module, attribute)) and attribute.startswith('__') is False and attribute != "execute" and attribute not in ignored_functions]
+        attacks = [getattr(Module, attribute) for attribute in dir(Module) if callable(getattr(Module, attribute)) and attribute.startswith('__') is False and attribute != "execute" and attribute not in self.ignored_functions]
 
         for attack in attacks:
             try:
@@ -4,7 +4,8 @@ import src.filter_modules as modules
 import src.log as log
 import src.service_process as service_process
 import src.constants as constants
-from multiprocessing import Process, Value
+import src.filter_stats as filter_stats
+from multiprocessing import Process, Value, Queue
 
 
 def main():
@@ -28,11 +29,17 @@ def main():
         for _ in range(len(services_names)):
             n_packets.append(Value('i', 0))
 
+    # filter statistics sent periodically by every service process
+    stats_queue = Queue()
+    stats_collector = filter_stats.StatsCollector(stats_queue)
+
     processes = []
     for index, service in enumerate(config_obj.services):
-        processes.append(Process(target=service_process.service_function, args=(
-                service, config_obj.global_config, n_packets[index]))
-            )
+        # workers of the same service share the listening port and the blocked packets counter
+        for _ in range(service.workers):
+            processes.append(Process(target=service_process.service_function, args=(
+                    service, config_obj.global_config, n_packets[index], stats_queue))
+                )
 
     for process in processes:
         process.start()
@@ -48,6 +55,12 @@ def main():
             break
         except:
             print("Error in opening log file")
+        try:
+            stats_collector.dump(constants.STATS_PATH)
+        except KeyboardInterrupt:
+            break
+        except Exception as e:
+            print("Error in writing filter stats:", str(e))
     for process in processes:
         process.join()
 
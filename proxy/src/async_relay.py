@@ -0,0 +1,253 @@
+import asyncio
+import socket
+import ssl
+import time
+import errno
+from src.classes import Service
+from src.stream import TCPStream, HTTPStream
+from src.http_parsing import MAX_DECOMPRESSED_SIZE, MAX_DECOMPRESSION_RATIO
+from src.framing import TCPFramer, HTTPFramer, FramingError, RECV_SIZE
+from collections import deque
+import src.utils as utils
+import src.ssl_utils as ssl_utils
+
+def serve(proxy_socket: socket.socket, service: Service, global_config: dict, watchdog_handler, count, budget=None, flag_scanner=None):
+    """Relay every connection of the service on a single asyncio event loop
+    instead of spawning a thread for each accepted socket."""
+    try:
+        asyncio.run(accept_loop(proxy_socket, service, global_config, watchdog_handler, count, budget, flag_scanner))
+    except KeyboardInterrupt:
+        pass
+
+
+async def accept_loop(proxy_socket: socket.socket, service: Service, global_config: dict, watchdog_handler, count, budget=None, flag_scanner=None):
+    loop = asyncio.get_running_loop()
+    proxy_socket.setblocking(False)
+    connections = set()
+    while True:
+        in_socket, in_addrinfo = await loop.sock_accept(proxy_socket)
+        utils.vprint(f'Connection from {in_addrinfo[0]},{in_addrinfo[1]}', global_config["verbose"])
+        task = asyncio.create_task(connection_task(in_socket, service, global_config, watchdog_handler, count, budget, flag_scanner))
+        # keep a reference to running tasks, the event loop only keeps weak ones
+        connections.add(task)
+        task.add_done_callback(connections.discard)
+
+
+async def wait_readable(sock: socket.socket):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    loop.add_reader(sock.fileno(), lambda: future.done() or future.set_result(None))
+    try:
+        await future
+    finally:
+        loop.remove_reader(sock.fileno())
+
+
+async def open_streams(sock: socket.socket, ssl_context: ssl.SSLContext = None, server_hostname: str = None, server_side=False):
+    """Build a StreamReader/StreamWriter pair on an already connected socket,
+    optionally running the TLS handshake on it"""
+    loop = asyncio.get_running_loop()
+    if not server_side:
+        return await asyncio.open_connection(sock=sock, ssl=ssl_context, server_hostname=server_hostname)
+    reader = asyncio.StreamReader()
+    protocol = asyncio.StreamReaderProtocol(reader)
+    transport, _ = await loop.connect_accepted_socket(lambda: protocol, sock, ssl=ssl_context)
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+
+async def connection_task(local_socket: socket.socket, service: Service, global_config: dict, watchdog_handler, count, budget=None, flag_scanner=None):
+    """Coroutine counterpart of service_process.connection_thread"""
+    loop = asyncio.get_running_loop()
+    remote_socket = socket.socket(utils.get_address_family(service.target_ip))
+    remote_socket.setblocking(False)
+    try:
+        await loop.sock_connect(remote_socket, (service.target_ip, service.target_port))
+        utils.vprint(f'Connected to {remote_socket.getpeername()[0]},{remote_socket.getpeername()[1]}', global_config["verbose"])
+    except socket.error as serr:
+        for s in [remote_socket, local_socket]:
+            s.close()
+        if serr.errno == errno.ECONNREFUSED:
+            print(
+                f'{time.strftime("%Y%m%d-%H%M%S")}, {service.target_ip}:{service.target_port}- Connection refused')
+            return None
+        elif serr.errno == errno.ETIMEDOUT:
+            print(
+                f'{time.strftime("%Y%m%d-%H%M%S")}, {service.target_ip}:{service.target_port}- Connection timed out')
+            return None
+        raise serr
+
+    contexts = None
+    if service.ssl:
+        # TLS clients always speak first: peek at the first bytes to choose
+        # between plain and TLS relaying, as ssl_utils.start_tls does
+        await wait_readable(local_socket)
+        try:
+            if ssl_utils.is_client_hello_bytes(local_socket.recv(128, socket.MSG_PEEK)):
+                contexts = ssl_utils.get_contexts(service.ssl)
+        except OSError:
+            pass
+
+    try:
+        local_reader, local_writer = await open_streams(local_socket, contexts and contexts.server, server_side=True)
+        sni = getattr(local_writer.get_extra_info("ssl_object"), "sni", None)
+        # asyncio requires a server_hostname with TLS, "" sends no SNI like the
+        # client did (the client context doesn't check the hostname)
+        remote_reader, remote_writer = await open_streams(remote_socket, contexts and ssl_utils.client_context_for(contexts, sni),
+                                                          server_hostname=(sni or "") if contexts else None)
+    except Exception as e:
+        if not isinstance(e, ssl.SSLError) or e.reason != "SSLV3_ALERT_CERTIFICATE_UNKNOWN":
+            print("SSL handshake failed", str(e))
+        for s in [remote_socket, local_socket]:
+            s.close()
+        return None
+    remote_tls = remote_writer.get_extra_info("ssl_object")
+    if remote_tls is not None:
+        remote_tls.sni = sni
+        remote_tls.contexts = contexts
+        ssl_utils.remember_session(remote_tls)
+        utils.vprint("SSL enabled", global_config["verbose"])
+
+    if service.http:
+        stream = HTTPStream(global_config["max_stored_messages"], global_config["max_message_size"],
+                            global_config.get("max_decompressed_size", MAX_DECOMPRESSED_SIZE),
+                            global_config.get("max_decompression_ratio", MAX_DECOMPRESSION_RATIO))
+    else:
+        stream = TCPStream(global_config["max_stored_messages"], global_config["max_message_size"])
+
+    peer = local_writer.get_extra_info("peername")
+    relay = Relay(service, global_config, watchdog_handler, count, stream, budget, flag_scanner, remote_tls)
+    # persistent framers keep the bytes received after a message for the next one
+    request_methods = deque()
+    local_framer, remote_framer = [HTTPFramer(request_methods) if service.http else TCPFramer() for _ in range(2)]
+    directions = [
+        asyncio.create_task(relay.forward(local_reader, local_framer, remote_writer, incoming=True)),
+        asyncio.create_task(relay.forward(remote_reader, remote_framer, local_writer, incoming=False))
+    ]
+    try:
+        await asyncio.wait(directions, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in directions:
+            task.cancel()
+
+    if relay.attack:
+        utils.vprint(f"Connection {peer[0]},{peer[1]} BLOCKED", global_config["verbose"])
+        block_answer = global_config["keyword"] + " " + service.name + " " + relay.attack
+        await block_packet(local_writer, utils.get_address_family(service.listen_ip), remote_writer,
+                           block_answer, global_config.get("dos", None))
+    else:
+        for writer in [remote_writer, local_writer]:
+            writer.close()
+
+
+class Relay():
+    """State shared by the two forwarding directions of a connection"""
+    def __init__(self, service: Service, global_config: dict, watchdog_handler, count, stream, budget=None, flag_scanner=None,
+                 remote_tls: ssl.SSLObject = None):
+        self.service = service
+        self.global_config = global_config
+        self.watchdog_handler = watchdog_handler
+        self.count = count
+        self.stream = stream
+        self.budget = budget
+        self.flag_scanner = flag_scanner
+        # TLS connection to the service, its session is stored to be resumed
+        self.remote_tls = remote_tls
+        # last bytes sent by the service, to find the flags split between two messages
+        self.flag_tail = b""
+        self.attack = None
+        # the two directions share the stream: like the thread relay, a single
+        # message at a time is filtered, also while the filters are awaited
+        self.filter_lock = asyncio.Lock()
+
+    async def forward(self, reader: asyncio.StreamReader, framer, writer: asyncio.StreamWriter, incoming: bool):
+        verbose = self.global_config["verbose"]
+        while True:
+            try:
+                message = await receive_from(reader, framer)
+            except (FramingError, ValueError) as e:
+                utils.vprint(str(e), verbose)
+                return
+            except OSError:
+                utils.vprint(
+                    f"{time.strftime('%Y%m%d-%H%M%S')}: Socket exception in connection_task: connection reset by local or remote host", verbose)
+                return
+
+            if not len(message):
+                utils.vprint("Connection from %s closed" % ("local client" if incoming else "remote server"), verbose)
+                return
+
+            if not incoming and self.remote_tls is not None:
+                # TLS 1.3 session tickets are received after the handshake
+                ssl_utils.remember_session(self.remote_tls)
+
+            async with self.filter_lock:
+                self.stream.set_current_message(message)
+                utils.vprint('Received %d bytes' % len(self.stream.current_message), verbose)
+
+                # the chains of a single version are used for the whole message
+                filters = self.watchdog_handler.filters
+                if incoming:
+                    utils.vprint(b'> > > in\n' + self.stream.current_message, verbose)
+                    chain = filters.in_chain
+                else:
+                    utils.vprint(b'< < < out\n' + self.stream.current_message, verbose)
+                    chain = filters.out_chain
+                if self.budget:
+                    attack = await self.budget.filter_packet_async(self.stream, chain)
+                elif chain.heavy:
+                    # the chain waits for the worker processes on a thread, not on the event loop
+                    attack = await asyncio.get_running_loop().run_in_executor(None, utils.filter_packet, self.stream, chain)
+                else:
+                    # filters are synchronous and run inline on the event loop
+                    attack = utils.filter_packet(self.stream, chain)
+                # the message as rewritten by the filters, before the other direction replaces it
+                message = self.stream.current_message
+                if not attack and not incoming and self.flag_scanner:
+                    attack, self.flag_tail = self.flag_scanner.check(self.flag_tail, message)
+
+            if attack:
+                self.attack = attack
+                with self.count.get_lock():
+                    self.count.value += 1
+                return
+
+            try:
+                writer.write(message)
+                await writer.drain()
+            except OSError:
+                return
+
+
+async def receive_from(reader: asyncio.StreamReader, framer):
+    """Coroutine counterpart of MessageReader.receive"""
+    while True:
+        message = framer.next_message()
+        if message is not None:
+            return message
+        data = await reader.read(RECV_SIZE)
+        if not data:
+            return framer.feed_eof() or b""
+        framer.feed(data)
+
+
+async def block_packet(local_writer: asyncio.StreamWriter, socket_family, remote_writer: asyncio.StreamWriter,
+                       block_answer: str, dos: dict = None):
+    """Coroutine counterpart of utils.block_packet: the answer is sent in clear
+    on the raw socket, also on TLS connections"""
+    loop = asyncio.get_running_loop()
+    remote_writer.close()
+    local_socket = socket.fromfd(local_writer.get_extra_info("socket").fileno(), socket_family, socket.SOCK_STREAM)
+    local_writer.transport.abort()
+    local_socket.setblocking(False)
+    try:
+        await loop.sock_sendall(local_socket, block_answer.encode())
+        if dos and dos.get("enabled"):
+            start = time.time()
+            while time.time() - start < dos["duration"]:
+                await loop.sock_sendall(local_socket, b".")
+                await asyncio.sleep(dos["interval"])
+    except Exception as e:
+        # socket has been closed by client
+        pass
+    local_socket.close()
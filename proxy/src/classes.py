@@ -1,22 +1,54 @@
+import threading
 from watchdog.events import RegexMatchingEventHandler
-from src.filter_modules import import_modules
+from src.filter_modules import FilterSet, load_filter_set
+from src.constants import RELOAD_DEBOUNCE_TIME
 from dataclasses import dataclass
 from typing import List
 
 
 class ModuleWatchdog(RegexMatchingEventHandler):
-    def __init__(self, regexes, in_module, out_module, name):
-        self.in_module = in_module
-        self.out_module = out_module
+    """
+    Reloads the modules of a service when they change. Editors emit several
+    events for a single save, so the reload starts RELOAD_DEBOUNCE_TIME seconds
+    after the last event, on a background thread. The new FilterSet is
+    validated before replacing the current one, which is kept if anything fails.
+    """
+    def __init__(self, regexes, filter_set: FilterSet, name, http=False, chain_options: dict = None):
         self.name = name
+        self.http = http
+        # FilterChain options of the service, used again on every reload
+        self.chain_options = chain_options or {}
+        # read once per message by the relays
+        self.filters = filter_set
+        self._timer = None
+        self._lock = threading.Lock()
         super().__init__(regexes=regexes)
 
     def on_modified(self, event):
-        print(self.name, "RELOADING", {event.src_path})
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            path = getattr(event, "dest_path", None) or event.src_path
+            self._timer = threading.Timer(RELOAD_DEBOUNCE_TIME, self.reload, args=(path,))
+            self._timer.daemon = True
+            self._timer.start()
+
+    # files saved by replacing them are created or moved, not modified
+    on_created = on_moved = on_modified
+
+    def reload(self, path=None):
+        print(self.name, "RELOADING", {path})
         try:
-            self.in_module, self.out_module = import_modules(self.name)
+            filter_set = load_filter_set(self.name, self.filters.version + 1, self.http, **self.chain_options)
         except Exception as e:
-            print(self.name, "ERROR in reloading:", str(e))
+            print(self.name, "ERROR in reloading:", str(e), "- still using version", self.filters.version)
+            return
+        self.filters = filter_set
+        print(self.name, "RELOADED version", filter_set.version)
+
+
+RELAY_MODES = ("thread", "asyncio")
+TIMEOUT_POLICIES = ("open", "closed")
 
 
 @dataclass
@@ -29,13 +61,41 @@ class SSLConfig:
 
 
 class Service:
-    def __init__(self, name: str, target_ip: str, target_port: int, listen_port: int, listen_ip: str = "::", http = False, ssl=None):
+    def __init__(self, name: str, target_ip: str, target_port: int, listen_port: int, listen_ip: str = "::", http = False, ssl=None, relay: str = "thread", workers: int = 1, zero_copy=False,
+                 filter_timeout: float = None, timeout_policy: str = "open", max_overruns: int = 0,
+                 heavy_workers: int = None, verdict_cache: int = 0, adaptive_order: int = 0, scan_flags=True):
         self.name = name
         self.target_ip = target_ip
         self.target_port = target_port
         self.listen_port = listen_port
         self.listen_ip = listen_ip
         self.http = http
+        if relay not in RELAY_MODES:
+            raise ValueError(f"Service {name}: unknown relay mode {relay}, expected one of {RELAY_MODES}")
+        self.relay = relay
+        if workers < 1:
+            raise ValueError(f"Service {name}: workers must be at least 1")
+        self.workers = workers
+        self.zero_copy = zero_copy
+        if filter_timeout is not None and filter_timeout <= 0:
+            raise ValueError(f"Service {name}: filter_timeout must be greater than 0")
+        self.filter_timeout = filter_timeout
+        if timeout_policy not in TIMEOUT_POLICIES:
+            raise ValueError(f"Service {name}: unknown timeout policy {timeout_policy}, expected one of {TIMEOUT_POLICIES}")
+        self.timeout_policy = timeout_policy
+        if max_overruns < 0:
+            raise ValueError(f"Service {name}: max_overruns can't be negative")
+        self.max_overruns = max_overruns
+        if heavy_workers is not None and heavy_workers < 1:
+            raise ValueError(f"Service {name}: heavy_workers must be at least 1")
+        self.heavy_workers = heavy_workers
+        if verdict_cache < 0:
+            raise ValueError(f"Service {name}: verdict_cache can't be negative")
+        self.verdict_cache = verdict_cache
+        if adaptive_order < 0:
+            raise ValueError(f"Service {name}: adaptive_order can't be negative")
+        self.adaptive_order = adaptive_order
+        self.scan_flags = scan_flags
         if ssl:
             self.ssl = SSLConfig(**ssl)
         else:
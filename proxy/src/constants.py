@@ -1,6 +1,10 @@
 CONFIG_PATH = "config/config.json"
 LOG_PATH = "log.txt"
+STATS_PATH = "stats.json"
+STATE_PATH = "state.db"
 MODULES_PATH = "./filter_modules"
 CERTIFICATES_PATH = "./config/certificates"
+CERTIFICATES_CHECK_TIME = 5
 LOG_REFRESH_TIME = 2
+RELOAD_DEBOUNCE_TIME = 0.5
 DB_URL = "mongodb://db:27017/"
\ No newline at end of file
@@ -0,0 +1,90 @@
+import math
+import string
+from collections import Counter
+from functools import cached_property
+from src.routes import request_line
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PRINTABLE = string.printable.encode()
+
+
+class MessageFeatures():
+    """
+    Data derived from the current message of a stream, shared by all the
+    filters: each feature is computed the first time a filter reads it and
+    dropped with the message.
+
+        if stream.features.entropy > 7.5: ...
+        if b"union select" in stream.features.lower: ...
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.message = stream.current_message
+
+    @cached_property
+    def lower(self) -> bytes:
+        return self.message.lower()
+
+    @cached_property
+    def non_printable(self) -> int:
+        """Number of bytes not in string.printable"""
+        return len(self.message.translate(None, PRINTABLE))
+
+    @cached_property
+    def printable_ratio(self) -> float:
+        if not self.message:
+            return 1.0
+        return 1 - self.non_printable / len(self.message)
+
+    @cached_property
+    def byte_counts(self) -> list:
+        """Occurrences of each byte value, indexed by byte"""
+        if numpy is not None:
+            return numpy.bincount(numpy.frombuffer(self.message, dtype=numpy.uint8), minlength=256).tolist()
+        counts = [0] * 256
+        for byte, count in Counter(self.message).items():
+            counts[byte] = count
+        return counts
+
+    @cached_property
+    def entropy(self) -> float:
+        """Shannon entropy in bits per byte, from 0 (a single repeated byte) to 8 (random data)"""
+        length = len(self.message)
+        if not length:
+            return 0.0
+        return -sum(count / length * math.log2(count / length) for count in self.byte_counts if count)
+
+    @cached_property
+    def _request_line(self):
+        return request_line(self.stream)
+
+    @property
+    def method(self) -> str:
+        """Method of the request of the message (for responses the latest request), None if not HTTP"""
+        return self._request_line[0]
+
+    @property
+    def path(self) -> str:
+        """URL decoded and normalized path of the request of the message (see method)"""
+        return self._request_line[1]
+
+    @cached_property
+    def parameters(self) -> dict:
+        """URL decoded parameters of an HTTP message, empty for TCP streams"""
+        http_message = getattr(self.stream, "current_http_message", None)
+        if http_message is None or not isinstance(http_message.parameters, dict):
+            return {}
+        return http_message.parameters
+
+    @cached_property
+    def parameters_lower(self) -> str:
+        """Names and values of the parameters as lowercase "name=value" lines, to search them all at once"""
+        lines = []
+        for name, values in self.parameters.items():
+            for value in values if isinstance(values, list) else [values]:
+                lines.append(f"{name}={value}")
+        return "\n".join(lines).lower()
@@ -0,0 +1,128 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from src.filter_chain import ChainProgress
+import src.utils as utils
+
+# threads running the filters of a service process
+FILTER_THREADS = 64
+
+
+class FilterBudget():
+    """
+    Runs the filter chains of a service with a time limit per message.
+
+    Python threads can't be interrupted, so the chain runs on a pool thread
+    and the connection stops waiting for it after `timeout` seconds of
+    execution: a filter stuck forever keeps busy a pool thread, not the
+    connection. The time spent waiting for a free pool thread doesn't count.
+    The chain works on a copy of the stream, taken back only if the chain
+    completes in time, and stops before its next filter once given up on.
+
+    policy: "open" forwards the message when the budget is exceeded, "closed"
+    blocks it
+    max_overruns: a filter that ran for the whole budget by itself is disabled
+    after this many overruns, until the module is reloaded (0 = never disabled)
+    """
+    def __init__(self, service_name: str, timeout: float, policy: str = "open", max_overruns: int = 0):
+        self.service_name = service_name
+        self.timeout = timeout
+        self.policy = policy
+        self.max_overruns = max_overruns
+        self.executor = ThreadPoolExecutor(max_workers=FILTER_THREADS, thread_name_prefix=f"{service_name}-filters")
+        # chains given up on and still running, ChainProgress -> FilterChain
+        self.abandoned = {}
+        self.lock = threading.Lock()
+
+    def _run(self, stream, chain, progress: ChainProgress):
+        progress.started = time.monotonic()
+        return utils.filter_packet(stream, chain, progress)
+
+    def _wait_time(self, progress: ChainProgress):
+        """Seconds to wait for the chain before checking it again, None to give up on a queued chain"""
+        started = progress.started
+        if started is None:
+            # waiting for a free thread is not charged to the filters, unless
+            # every thread is held by a chain already given up on
+            return None if len(self.abandoned) >= FILTER_THREADS else self.timeout
+        return max(started + self.timeout - time.monotonic(), 0)
+
+    def _expired(self, progress: ChainProgress) -> bool:
+        return progress.started is not None and time.monotonic() - progress.started >= self.timeout
+
+    def _charge(self, chain, progress: ChainProgress):
+        """Counts the overrun of the filter an abandoned chain is running, once it alone used the whole budget"""
+        running = progress.running
+        if progress.charged or running is None or time.monotonic() - running[1] < self.timeout:
+            return
+        progress.charged = True
+        print(f"{time.strftime('%Y%m%d-%H%M%S')}: {self.service_name} filter {chain.direction}/{running[0]} "
+              f"exceeded the time budget of {self.timeout}s")
+        if chain.overrun(running[0], self.max_overruns):
+            print(f"{self.service_name} filter {chain.direction}/{running[0]} DISABLED until the next reload")
+
+    def _finished(self, chain, progress: ChainProgress):
+        with self.lock:
+            self._charge(chain, progress)
+            self.abandoned.pop(progress, None)
+
+    def _overrun(self, chain, progress: ChainProgress, future):
+        running = progress.running
+        if progress.started is None:
+            print(f"{time.strftime('%Y%m%d-%H%M%S')}: {self.service_name} filters of direction {chain.direction} "
+                  f"not started, all the filter threads are held by chains over the time budget")
+        else:
+            progress.abandoned = True
+            print(f"{time.strftime('%Y%m%d-%H%M%S')}: {self.service_name} filters of direction {chain.direction} "
+                  f"exceeded the time budget of {self.timeout}s while running {running[0] if running else None}")
+            with self.lock:
+                self.abandoned[progress] = chain
+                # filters stuck forever are charged here, the others when they return
+                for other, other_chain in self.abandoned.items():
+                    self._charge(other_chain, other)
+            future.add_done_callback(lambda _: self._finished(chain, progress))
+        if self.policy == "closed":
+            return f"{running[0] if running else 'filters'}_timeout"
+        return None
+
+    def filter_packet(self, stream, chain):
+        """Counterpart of utils.filter_packet with the time budget"""
+        progress = ChainProgress()
+        clone = stream.copy()
+        future = self.executor.submit(self._run, clone, chain, progress)
+        while True:
+            wait_time = self._wait_time(progress)
+            if wait_time is None:
+                if future.cancel():
+                    return self._overrun(chain, progress, future)
+                continue
+            try:
+                attack = future.result(wait_time)
+                break
+            except TimeoutError:
+                if self._expired(progress):
+                    return self._overrun(chain, progress, future)
+        stream.adopt(clone)
+        return attack
+
+    async def filter_packet_async(self, stream, chain):
+        """Coroutine counterpart of filter_packet, the event loop keeps running while the filters do"""
+        progress = ChainProgress()
+        clone = stream.copy()
+        future = self.executor.submit(self._run, clone, chain, progress)
+        waiter = asyncio.wrap_future(future)
+        while True:
+            wait_time = self._wait_time(progress)
+            if wait_time is None:
+                if future.cancel():
+                    return self._overrun(chain, progress, future)
+                await asyncio.sleep(0)
+                continue
+            done, _ = await asyncio.wait((waiter,), timeout=wait_time)
+            if done:
+                break
+            if self._expired(progress):
+                return self._overrun(chain, progress, future)
+        stream.adopt(clone)
+        return waiter.result()
@@ -0,0 +1,291 @@
+import ast
+import sys
+from time import monotonic, perf_counter_ns
+import src.filter_stats as filter_stats
+import src.heavy_filters as heavy_filters
+from src.filter_decorators import is_cpu_heavy, is_stateless, get_pin, get_route
+from src.routes import RouteIndex
+from src.verdict_cache import VerdictCache
+
+
+def get_ignored_functions(module_class) -> set:
+    """
+    Names of the filters disabled by the module. They can be listed in an
+    ignored_functions class attribute or, as in the modules generated by older
+    templates, in the ignored_functions list inside Module.execute.
+    """
+    ignored = getattr(module_class, "ignored_functions", None)
+    if ignored is not None:
+        return set(ignored)
+    try:
+        module_file = sys.modules[module_class.__module__]
+        source = getattr(module_file, "__source__", None)
+        if source is None:
+            with open(module_file.__file__) as f:
+                source = f.read()
+        tree = ast.parse(source)
+    except (AttributeError, KeyError, OSError, SyntaxError, TypeError):
+        return set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.FunctionDef) and node.name == "execute":
+            for statement in ast.walk(node):
+                if (isinstance(statement, ast.Assign) and
+                        any(isinstance(target, ast.Name) and target.id == "ignored_functions" for target in statement.targets)):
+                    try:
+                        return set(ast.literal_eval(statement.value))
+                    except ValueError:
+                        return set()
+    return set()
+
+
+def apply_pins(items: list, pins: dict, get_name) -> list:
+    """Moves the pinned items to their position (negative positions count from the end), the others keep their order"""
+    ordered = [item for item in items if get_name(item) not in pins]
+    pinned = []
+    for item in items:
+        if get_name(item) in pins:
+            position = pins[get_name(item)]
+            if position < 0:
+                position += len(items)
+            pinned.append((max(0, min(position, len(items) - 1)), item))
+    for position, item in sorted(pinned, key=lambda pinned_item: pinned_item[0]):
+        ordered.insert(position, item)
+    return ordered
+
+
+class ChainProgress():
+    """
+    State of a chain run with a time budget, read when the chain exceeds it.
+
+    started: monotonic time the chain began executing (None while queued)
+    running: (name, monotonic start time) of the filter being run
+    abandoned: set when the relay gives up on the chain, which stops before
+    the next filter
+    charged: the running filter has been charged with the overrun
+    """
+    __slots__ = ("started", "running", "abandoned", "charged")
+
+    def __init__(self):
+        self.started = None
+        self.running = None
+        self.abandoned = False
+        self.charged = False
+
+    def enter(self, filter_name: str):
+        self.running = (filter_name, monotonic())
+
+
+class FilterChain():
+    """
+    Filters of a module, collected once per (re)load.
+
+    filters: tuple of the bound filter methods of the module, in the same
+    order Module.execute would run them
+
+    rules: RuleSet of the direction, evaluated before the filters so cheap
+    regexes short-circuit the Python code
+
+    Consecutive filters marked as CPU heavy are grouped and run in the worker
+    processes of the service, in the same position of the chain.
+
+    version: version of the FilterSet of the chain. The workers run the
+    source the module was loaded from, cached by version, never the file on
+    disk, which may hold a newer version that failed to load
+
+    routes: RouteIndex of the filters decorated with @route, which are skipped
+    when the request doesn't match
+
+    verdict_cache: maximum number of entries of the VerdictCache of the
+    stateless filters, 0 disables it
+
+    adaptive_order: every adaptive_order messages the stateless filters that
+    are not pinned are sorted by block rate / cost measured since the chain
+    was built, so attacks are blocked with the least work. 0 disables it
+
+    Every filter (and the rules as a whole) has a FilterCounter in the stats
+    registry of the process, keyed by service, direction and filter name, so
+    counters survive reloads.
+
+    The proxy calls execute() instead of the module's own execute, so messages
+    don't pay the dir()/getattr reflection.
+    """
+    def __init__(self, module, rules=None, service_name: str = "", direction: str = "",
+                 verdict_cache: int = 0, adaptive_order: int = 0, version: int = 0):
+        self.module = module
+        self.rules = rules
+        self.service_name = service_name
+        self.direction = direction
+        module_class = type(module)
+        ignored_functions = get_ignored_functions(module_class)
+        filters = [getattr(module, attribute) for attribute in dir(module_class)
+                   if callable(getattr(module_class, attribute)) and
+                   not attribute.startswith('__') and
+                   attribute != "execute" and
+                   attribute not in ignored_functions]
+        self.pins = {attack.__name__: get_pin(module_class, attack.__name__) for attack in filters
+                     if get_pin(module_class, attack.__name__) is not None}
+        self.filters = tuple(apply_pins(filters, self.pins, lambda attack: attack.__name__))
+        self.rules_counter = filter_stats.registry.counter(service_name, direction, "rules") if rules else None
+        self.counters = tuple(filter_stats.registry.counter(service_name, direction, attack.__name__)
+                              for attack in self.filters)
+        self.heavy = frozenset(attack.__name__ for attack in self.filters if is_cpu_heavy(module_class, attack.__name__))
+        if self.heavy:
+            # worker processes load the module from its source and reload it when the version changes
+            module_file = sys.modules[module_class.__module__]
+            self.module_path = module_file.__file__
+            self.module_version = version
+            self.module_source = getattr(module_file, "__source__", None)
+            if self.module_source is None:
+                with open(self.module_path, "rb") as f:
+                    self.module_source = f.read()
+        self.stateless = frozenset(attack.__name__ for attack in self.filters if is_stateless(module_class, attack.__name__))
+        self.cache = VerdictCache(verdict_cache) if verdict_cache and self.stateless else None
+        routes = {attack.__name__: get_route(module_class, attack.__name__) for attack in self.filters
+                  if get_route(module_class, attack.__name__) is not None}
+        self.routes = RouteIndex(routes) if routes else None
+        self.adaptive_order = adaptive_order
+        # counters of the registry when the chain is built: the order only depends on this version of the module
+        self._baseline = {counter: (counter.invocations, counter.blocks, counter.total_ns) for counter in self.counters}
+        self._executions = 0
+        self._set_steps(tuple(zip(self.filters, self.counters)))
+        self.overruns = {}
+
+    def _set_steps(self, entries):
+        """
+        steps: (step, cacheable, step id, movable) tuples, where step is a
+        (filter, counter) pair or a HeavyGroup of consecutive CPU heavy
+        filters. Groups are cacheable/movable if all their filters are
+        stateless (and not pinned). The step id is the cache key of the step.
+        Replaced as a whole when a filter is disabled or the chain reordered.
+        """
+        steps = []
+        group = []
+        # routed filters are alone in their group, so a group is either run or skipped
+        routed = self.routes.routed if self.routes else ()
+        for attack, counter in entries + ((None, None),):
+            name = attack.__name__ if attack is not None else None
+            if group and (name not in self.heavy or (name in self.stateless) != (group[0][0] in self.stateless) or
+                          name in routed or group[0][0] in routed):
+                names, counters = zip(*group)
+                steps.append((heavy_filters.HeavyGroup(names, counters), names[0] in self.stateless,
+                              len(steps), names[0] in self.stateless and not any(name in self.pins for name in names)))
+                group = []
+            if attack is None:
+                break
+            if name in self.heavy:
+                group.append((name, counter))
+            else:
+                steps.append(((attack, counter), name in self.stateless, len(steps),
+                              name in self.stateless and name not in self.pins))
+        self.filters = tuple(attack for attack, _ in entries)
+        self.counters = tuple(counter for _, counter in entries)
+        self._entries = entries
+        if self.cache is not None:
+            # step ids change
+            self.cache.clear()
+        self._steps = tuple(steps)
+
+    def _score(self, step):
+        """Block probability / average cost of a step since the chain was built"""
+        counters = step.counters if type(step) is heavy_filters.HeavyGroup else step[1:]
+        calls = counters[0].invocations - self._baseline[counters[0]][0]
+        blocks = sum(counter.blocks - self._baseline[counter][1] for counter in counters)
+        total_ns = sum(counter.total_ns - self._baseline[counter][2] for counter in counters)
+        # smoothed, so filters that haven't run yet are neither first nor last
+        return ((blocks + 1) / (calls + 2)) / ((total_ns + 1) / (calls + 1))
+
+    def reorder(self):
+        """Sorts the movable steps by score, the other steps keep their position"""
+        steps = self._steps
+        movable = sorted((entry for entry in steps if entry[3]), key=lambda entry: self._score(entry[0]), reverse=True)
+        movable = iter(movable)
+        self._steps = tuple(next(movable) if entry[3] else entry for entry in steps)
+
+    def _run_step(self, step, stream, progress: ChainProgress):
+        if type(step) is heavy_filters.HeavyGroup:
+            if progress is not None:
+                progress.enter(step.names[0])
+            return step.execute(self, stream)
+        attack, counter = step
+        if progress is not None:
+            progress.enter(attack.__name__)
+        start = perf_counter_ns()
+        try:
+            result = attack(stream)
+        except IndexError:
+            counter.record(perf_counter_ns() - start, False)
+            return None
+        except Exception:
+            counter.errors += 1
+            counter.record(perf_counter_ns() - start, False)
+            raise
+        counter.record(perf_counter_ns() - start, result)
+        if result:
+            return result if isinstance(result, str) else attack.__name__
+        return None
+
+    def execute(self, stream, progress: ChainProgress = None):
+        """
+        Returns the name of the first filter that identifies an attack (or the
+        string returned by the filter), None if no attack has been identified.
+        """
+        rules = self.rules
+        if rules:
+            if progress is not None:
+                progress.enter("rules")
+            start = perf_counter_ns()
+            attack = rules.match(stream)
+            self.rules_counter.record(perf_counter_ns() - start, attack)
+            if attack:
+                return attack
+        if self.adaptive_order:
+            self._executions += 1
+            if self._executions % self.adaptive_order == 0:
+                self.reorder()
+        skipped = self.routes.skipped(stream) if self.routes else ()
+        cache = self.cache
+        for step, cacheable, step_id, _ in self._steps:
+            if progress is not None and progress.abandoned:
+                return None
+            if skipped and (step.names[0] if type(step) is heavy_filters.HeavyGroup else step[0].__name__) in skipped:
+                continue
+            if cache is None or not cacheable:
+                attack = self._run_step(step, stream, progress)
+            else:
+                message = stream.current_message
+                key = (step_id, hash(message), len(message))
+                cached = cache.get(key)
+                if cached is None:
+                    attack = self._run_step(step, stream, progress)
+                    cache.put(key, attack, stream.current_message if stream.current_message is not message else None)
+                else:
+                    attack, rewritten = cached
+                    if rewritten is not None:
+                        stream.current_message = rewritten
+                    for counter in (step.counters if type(step) is heavy_filters.HeavyGroup else step[1:]):
+                        counter.cache_hits += 1
+            if attack:
+                return attack
+        return None
+
+    def overrun(self, filter_name: str, max_overruns: int = 0) -> bool:
+        """
+        Counts a time budget overrun of a filter. After max_overruns overruns
+        (0 = never) the filter is disabled until the module is reloaded.
+        Returns True if the filter has been disabled.
+        """
+        filter_stats.registry.counter(self.service_name, self.direction, filter_name).timeouts += 1
+        self.overruns[filter_name] = self.overruns.get(filter_name, 0) + 1
+        if max_overruns and self.overruns[filter_name] == max_overruns:
+            self.disable(filter_name)
+            return True
+        return False
+
+    def disable(self, filter_name: str):
+        if filter_name == "rules":
+            self.rules = None
+            return
+        self._set_steps(tuple((attack, counter) for attack, counter in self._entries if attack.__name__ != filter_name))
+
+    def is_empty(self):
+        return not self.filters and not self.rules
@@ -0,0 +1,99 @@
+"""
+Decorators to give the proxy hints about the filters of a Module:
+
+    from src.filter_decorators import cpu_heavy, stateless, pin, route, no_dry_run
+
+    class Module():
+        @cpu_heavy
+        def parse_everything(self, stream: TCPStream):
+            ...
+"""
+
+
+def cpu_heavy(function):
+    """The filter is CPU bound: it runs in a worker process of the service instead of the connection thread"""
+    function.cpu_heavy = True
+    return function
+
+
+def stateless(function):
+    """
+    The verdict of the filter only depends on current_message: it doesn't read
+    previous_messages (or the parsed previous messages) and has no side effects,
+    so it can be cached
+    """
+    function.stateless = True
+    return function
+
+
+def pin(position: int):
+    """
+    The filter always runs at this position of the chain (0 is the first
+    filter, -1 the last one), also when the chain is reordered by adaptive_order
+    """
+    def decorator(function):
+        function.pin = position
+        return function
+    return decorator
+
+
+def route(methods=None, paths=None, patterns=None):
+    """
+    HTTP services only: the filter runs only on the requests (and on their
+    responses) with one of the methods and a path starting with one of the
+    prefixes or matching one of the regex patterns. None means any.
+
+        @route(methods=["POST"], paths=["/register", "/login"])
+    """
+    def decorator(function):
+        function.route = (methods, paths, patterns)
+        return function
+    return decorator
+
+
+def no_dry_run(function):
+    """
+    The filter is not run on the sample message when the module is loaded,
+    e.g. because it calls external services
+    """
+    function.no_dry_run = True
+    return function
+
+
+def is_cpu_heavy(module_class, name: str) -> bool:
+    """Filters can be decorated with @cpu_heavy or listed in the cpu_heavy_functions class attribute"""
+    return (getattr(getattr(module_class, name), "cpu_heavy", False) or
+            name in getattr(module_class, "cpu_heavy_functions", ()))
+
+
+def is_stateless(module_class, name: str) -> bool:
+    """Filters can be decorated with @stateless or listed in the stateless_functions class attribute"""
+    return (getattr(getattr(module_class, name), "stateless", False) or
+            name in getattr(module_class, "stateless_functions", ()))
+
+
+def is_dry_run(module_class, name: str) -> bool:
+    """Filters can skip the dry run with @no_dry_run or by being listed in the no_dry_run_functions class attribute"""
+    return not (getattr(getattr(module_class, name), "no_dry_run", False) or
+                name in getattr(module_class, "no_dry_run_functions", ()))
+
+
+def get_pin(module_class, name: str):
+    """Position of the filter, set with @pin or in the pinned_functions class attribute ({name: position}), None if not pinned"""
+    position = getattr(getattr(module_class, name), "pin", None)
+    if position is None:
+        position = getattr(module_class, "pinned_functions", {}).get(name)
+    return position
+
+
+def get_route(module_class, name: str):
+    """
+    (methods, paths, patterns) of the filter, set with @route or in the
+    routed_functions class attribute ({name: {"methods": [...], "paths": [...],
+    "patterns": [...]}}), None if the filter runs on every message
+    """
+    route = getattr(getattr(module_class, name), "route", None)
+    if route is None and name in getattr(module_class, "routed_functions", {}):
+        route = module_class.routed_functions[name]
+        route = (route.get("methods"), route.get("paths"), route.get("patterns"))
+    return route
@@ -1,7 +1,14 @@
 import os
-import importlib
+import importlib.util
 import sys
 import shutil
+from dataclasses import dataclass
+from src.constants import MODULES_PATH
+from src.filter_chain import FilterChain
+from src.filter_decorators import is_dry_run
+from src.rules import load_rules, DIRECTIONS
+from src.state import scratch_state
+from src.stream import TCPStream, HTTPStream
 
 
 def generate_module_files(service_names, base_directory):
@@ -23,20 +30,105 @@ def generate_module_files(service_names, base_directory):
             os.chmod(out_module_path, 0o777)
 
 
-def import_modules(service_name, reload=True):
-    in_module_name = service_name + "_in"
-    out_module_name = service_name + "_out"
+@dataclass(frozen=True)
+class FilterSet:
+    """
+    In and out chains of a service, replaced as a single object on reload so a
+    message never sees the chains of two different versions
+    """
+    version: int
+    in_chain: FilterChain
+    out_chain: FilterChain
+
+    # directions without filters can be relayed without inspection
+    @property
+    def in_filtered(self) -> bool:
+        return not self.in_chain.is_empty()
+
+    @property
+    def out_filtered(self) -> bool:
+        return not self.out_chain.is_empty()
+
+
+def get_module_path(service_name, direction):
+    return os.path.join(MODULES_PATH, service_name, f"{service_name}_{direction}.py")
+
+
+def load_module(service_name, direction):
+    """
+    Executes the module file in a new module object, without touching the
+    loaded one. The executed source is kept in __source__, the worker
+    processes of the CPU heavy filters run the same code.
+    """
+    module_name = f"{service_name}_{direction}"
+    path = get_module_path(service_name, direction)
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    if spec is None:
+        raise ImportError(f"Module {module_name} not found")
+    module = importlib.util.module_from_spec(spec)
+    with open(path, "rb") as f:
+        module.__source__ = f.read()
+    exec(compile(module.__source__, path, "exec"), module.__dict__)
+    return module
+
+
+def sample_stream(http: bool, direction: str):
+    """Stream used for the dry run of the filters of a new module version"""
+    if not http:
+        stream = TCPStream()
+        stream.set_current_message(b"sample\n")
+    elif direction == "in":
+        stream = HTTPStream()
+        stream.set_current_message(b"GET /?sample=1 HTTP/1.1\r\nHost: localhost\r\nUser-Agent: sample\r\n\r\n")
+    else:
+        stream = HTTPStream()
+        stream.set_current_message(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\nContent-Length: 6\r\n\r\nsample")
+    return stream
+
+
+def dry_run(chain: FilterChain, http: bool):
+    """
+    Runs every filter of the chain once on a sample stream. The filters are
+    called directly, so the dry run doesn't show up in the stats, and their
+    StateStore operations go to a temporary store. Exceptions are only
+    warnings: a filter may legitimately fail on the sample message.
+    """
+    module_class = type(chain.module)
+    with scratch_state():
+        for attack in chain.filters:
+            if not is_dry_run(module_class, attack.__name__):
+                continue
+            try:
+                attack(sample_stream(http, chain.direction))
+            except IndexError:
+                pass
+            except Exception as e:
+                print(f"{chain.service_name} WARNING: filter {chain.direction}/{attack.__name__} "
+                      f"raised {type(e).__name__} in the dry run: {e}")
+
+
+def load_filter_set(service_name, version=0, http=False, **chain_options) -> FilterSet:
+    """
+    Loads the modules and the rules of the service, builds their chains and
+    dry runs them. Raises an exception if the new version can't be used, in
+    that case sys.modules is left untouched.
+    """
+    modules = {direction: load_module(service_name, direction) for direction in DIRECTIONS}
+    in_rules, out_rules = load_rules(service_name)
+    previous = {module.__name__: sys.modules.get(module.__name__) for module in modules.values()}
     try:
-        if reload:
-            importlib.reload(importlib.import_module((in_module_name)))
-            importlib.reload(importlib.import_module((out_module_name)))
-        else:
-            __import__(in_module_name)
-            __import__(out_module_name)
-        in_module = sys.modules[in_module_name].Module()
-        out_module = sys.modules[out_module_name].Module()
-    except ImportError as e:
-        print('Module %s not found' % service_name)
-        print(e.msg)
-        sys.exit(3)
-    return in_module, out_module
+        # the chains look for the file of their module in sys.modules
+        for module in modules.values():
+            sys.modules[module.__name__] = module
+        in_chain = FilterChain(modules["in"].Module(), in_rules, service_name, "in", version=version, **chain_options)
+        out_chain = FilterChain(modules["out"].Module(), out_rules, service_name, "out", version=version, **chain_options)
+    except BaseException:
+        for module_name, module in previous.items():
+            if module is None:
+                sys.modules.pop(module_name, None)
+            else:
+                sys.modules[module_name] = module
+        raise
+    for chain in (in_chain, out_chain):
+        dry_run(chain, http)
+    return FilterSet(version, in_chain, out_chain)
@@ -0,0 +1,136 @@
+import json
+import os
+import queue
+import threading
+import time
+
+# latency histogram with power of two buckets: bucket i counts the calls that
+# took less than 2^i nanoseconds (and at least 2^(i-1))
+HISTOGRAM_BUCKETS = 48
+
+
+class FilterCounter():
+    """
+    Counters of a single filter in a process.
+    Updates are not locked: under heavy contention a few increments may be
+    lost, which is fine for statistics and keeps the overhead negligible.
+    """
+    __slots__ = ("invocations", "blocks", "errors", "timeouts", "cache_hits", "total_ns", "max_ns", "histogram")
+
+    def __init__(self):
+        self.invocations = 0
+        self.blocks = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.cache_hits = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def record(self, elapsed_ns: int, blocked):
+        self.invocations += 1
+        if blocked:
+            self.blocks += 1
+        self.total_ns += elapsed_ns
+        self.histogram[min(elapsed_ns.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        if elapsed_ns > self.max_ns:
+            self.max_ns = elapsed_ns
+
+    def snapshot(self):
+        return {"invocations": self.invocations, "blocks": self.blocks, "errors": self.errors,
+                "timeouts": self.timeouts, "cache_hits": self.cache_hits, "max_ns": self.max_ns, "histogram": list(self.histogram)}
+
+
+class StatsRegistry():
+    """Counters of all the filters of a process, by service, direction and filter name"""
+    def __init__(self):
+        self.counters = {}
+
+    def counter(self, service_name: str, direction: str, filter_name: str) -> FilterCounter:
+        key = (service_name, direction, filter_name)
+        counter = self.counters.get(key)
+        if counter is None:
+            counter = self.counters.setdefault(key, FilterCounter())
+        return counter
+
+    def snapshot(self):
+        return {key: counter.snapshot() for key, counter in list(self.counters.items())}
+
+
+# counters of the current process
+registry = StatsRegistry()
+
+
+def reporter(stats_queue, interval):
+    """Periodically sends the counters of this process to the main process"""
+    def report():
+        while True:
+            time.sleep(interval)
+            try:
+                stats_queue.put((os.getpid(), registry.snapshot()))
+            except Exception as e:
+                print("Error in sending filter stats:", str(e))
+                return
+
+    thread = threading.Thread(target=report, daemon=True)
+    thread.start()
+    return thread
+
+
+def _percentile(histogram, total, fraction):
+    threshold = total * fraction
+    seen = 0
+    for bucket, calls in enumerate(histogram):
+        seen += calls
+        if seen >= threshold:
+            return 2 ** bucket
+    return 2 ** (len(histogram) - 1)
+
+
+class StatsCollector():
+    """Keeps the latest counters sent by every process and aggregates them"""
+    def __init__(self, stats_queue):
+        self.stats_queue = stats_queue
+        self.snapshots = {}
+
+    def collect(self):
+        while True:
+            try:
+                pid, snapshot = self.stats_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.snapshots[pid] = snapshot
+
+    def summary(self):
+        merged = {}
+        for snapshot in self.snapshots.values():
+            for key, counter in snapshot.items():
+                total = merged.setdefault(key, FilterCounter().snapshot())
+                for field in ("invocations", "blocks", "errors", "timeouts", "cache_hits"):
+                    total[field] += counter[field]
+                total["max_ns"] = max(total["max_ns"], counter["max_ns"])
+                total["histogram"] = [a + b for a, b in zip(total["histogram"], counter["histogram"])]
+
+        summary = {}
+        for (service_name, direction, filter_name), counter in sorted(merged.items()):
+            calls = sum(counter["histogram"])
+            hits = counter["cache_hits"]
+            summary.setdefault(service_name, {}).setdefault(direction, {})[filter_name] = {
+                "invocations": counter["invocations"],
+                "blocks": counter["blocks"],
+                "errors": counter["errors"],
+                "timeouts": counter["timeouts"],
+                "cache_hits": hits,
+                # share of the messages answered by the verdict cache instead of running the filter
+                "cache_hit_rate": round(hits / (hits + counter["invocations"]), 3) if hits else 0.0,
+                # upper bounds of the histogram buckets, capped by the slowest call
+                "p50_ms": min(_percentile(counter["histogram"], calls, 0.50), counter["max_ns"]) / 1e6 if calls else None,
+                "p99_ms": min(_percentile(counter["histogram"], calls, 0.99), counter["max_ns"]) / 1e6 if calls else None,
+                "max_ms": counter["max_ns"] / 1e6
+            }
+        return summary
+
+    def dump(self, path):
+        self.collect()
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=1)
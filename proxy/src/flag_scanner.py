@@ -0,0 +1,74 @@
+import re
+import time
+from time import perf_counter_ns
+import src.filter_stats as filter_stats
+
+FLAG_ACTIONS = ("block", "report")
+# attack name of the blocked responses
+FLAG_LEAK = "flag_leak"
+
+
+class FlagScanner():
+    """
+    Looks for flags in the data sent by a service, also when a flag is split
+    between two messages (e.g. two TCP reads).
+
+    The caller keeps the tail of the previous messages of the connection (at
+    most max_length - 1 bytes): only the boundary between the tail and the new
+    message is scanned again, never the whole history.
+
+    regex: regex of the flags
+    max_length: maximum length of a flag
+    action: "block" the message containing a flag, or just "report" it
+    """
+    def __init__(self, service_name: str, regex: str, max_length: int = 64, action: str = "block"):
+        if action not in FLAG_ACTIONS:
+            raise ValueError(f"Unknown flag action {action}, expected one of {FLAG_ACTIONS}")
+        self.service_name = service_name
+        self.regex = re.compile(regex.encode())
+        self.max_length = max_length
+        self.block = action == "block"
+        self.counter = filter_stats.registry.counter(service_name, "out", FLAG_LEAK)
+
+    @classmethod
+    def from_config(cls, service_name: str, flag_config: dict):
+        """FlagScanner of the "flag_scanner" entry of the global config, None if it is not set"""
+        if not flag_config or not flag_config.get("regex"):
+            return None
+        return cls(service_name, flag_config["regex"], flag_config.get("max_length", 64), flag_config.get("action", "block"))
+
+    def scan(self, tail: bytes, data: bytes):
+        """Returns (first new flag found or None, tail to pass with the next message)"""
+        flag = None
+        if tail:
+            # matches ending inside the tail have already been found with the previous message
+            boundary = tail + data[:self.max_length - 1]
+            match = self.regex.search(boundary)
+            while match and match.end() <= len(tail):
+                match = self.regex.search(boundary, match.start() + 1)
+            if match:
+                flag = match.group()
+        if flag is None:
+            match = self.regex.search(data)
+            if match:
+                flag = match.group()
+        keep = self.max_length - 1
+        if len(data) >= keep:
+            tail = data[len(data) - keep:]
+        else:
+            tail = (tail + data)[-keep:]
+        return flag, tail
+
+    def check(self, tail: bytes, data: bytes):
+        """
+        Scans a message sent by the service. Returns (attack name or None, tail),
+        the attack name is FLAG_LEAK if the message must be blocked.
+        """
+        start = perf_counter_ns()
+        flag, tail = self.scan(tail, data)
+        self.counter.record(perf_counter_ns() - start, flag is not None)
+        if flag is None:
+            return None, tail
+        print(f"{time.strftime('%Y%m%d-%H%M%S')}: {self.service_name} flag {flag.decode(errors='replace')} "
+              f"{'BLOCKED' if self.block else 'sent'}")
+        return (FLAG_LEAK if self.block else None), tail
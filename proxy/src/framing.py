@@ -0,0 +1,225 @@
+import socket
+import ssl
+from collections import deque
+
+# size of the preallocated buffer used by recv_into
+RECV_SIZE = 65536
+MAX_LINE_SIZE = 65536
+MAX_HEADERS = 100
+
+# HTTP framing states
+START_LINE, HEADERS, BODY, CHUNK_SIZE, CHUNK_DATA, CHUNK_END, TRAILERS, UNTIL_CLOSE = range(8)
+
+
+class FramingError(Exception):
+    pass
+
+
+class TCPFramer():
+    """Every chunk of data received is a message"""
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_message(self):
+        if not self.buffer:
+            return None
+        message = bytes(self.buffer)
+        self.buffer.clear()
+        return message
+
+    def feed_eof(self):
+        return self.next_message()
+
+
+class HTTPFramer():
+    """
+    Incremental HTTP/1.1 framing state machine.
+
+    Data is appended to the receive buffer with feed(), next_message() returns
+    the first complete request/response of the buffer (or None) and leaves the
+    following bytes in the buffer for the next message, so keep-alive and
+    pipelined connections are framed correctly.
+
+    request_methods is shared by the two framers of a connection: the methods
+    of the requests are queued to know whether the matching response has a
+    body (responses to HEAD don't).
+    """
+    def __init__(self, request_methods: deque = None):
+        self.buffer = bytearray()
+        self.request_methods = request_methods if request_methods is not None else deque()
+        self._reset()
+
+    def _reset(self):
+        self._state = START_LINE
+        self._pos = 0           # end of the already framed part of the buffer
+        self._remaining = 0     # bytes of body/chunk still to be received
+        self._headers = 0
+        self._content_length = None
+        self._chunked = False
+        self._is_response = False
+        self._has_body = True
+
+    def feed(self, data):
+        self.buffer += data
+
+    def _readline(self):
+        end = self.buffer.find(b"\n", self._pos)
+        if end < 0:
+            if len(self.buffer) - self._pos > MAX_LINE_SIZE:
+                raise FramingError("Header line too long.")
+            return None
+        line = bytes(self.buffer[self._pos:end + 1])
+        self._pos = end + 1
+        return line
+
+    def _emit(self):
+        message = bytes(self.buffer[:self._pos])
+        del self.buffer[:self._pos]
+        self._reset()
+        return message
+
+    def _parse_start_line(self, line):
+        if line.startswith(b"HTTP/"):
+            self._is_response = True
+            try:
+                status = int(line.split(None, 2)[1])
+            except (IndexError, ValueError):
+                status = 200
+            if status >= 200 or status == 101:
+                method = self.request_methods.popleft() if self.request_methods else None
+                self._has_body = method != b"HEAD" and status not in (204, 304) and status != 101
+            else:
+                # informational responses (100 Continue) have no body and are not final
+                self._has_body = False
+        else:
+            self.request_methods.append(line.split(b" ", 1)[0])
+
+    def _parse_header(self, line):
+        self._headers += 1
+        if self._headers > MAX_HEADERS:
+            raise FramingError("Too many headers")
+        name, _, value = line.partition(b":")
+        name = name.strip().lower()
+        if name == b"content-length":
+            self._content_length = int(value)
+        elif name == b"transfer-encoding":
+            self._chunked = b"chunked" in value.lower()
+
+    def _end_of_headers(self):
+        if not self._has_body:
+            return self._emit()
+        if self._chunked:
+            self._state = CHUNK_SIZE
+        elif self._content_length:
+            self._state = BODY
+            self._remaining = self._content_length
+        elif self._is_response and self._content_length is None:
+            # the body ends when the service closes the connection
+            self._state = UNTIL_CLOSE
+        else:
+            return self._emit()
+        return None
+
+    def next_message(self):
+        """Returns the next complete message, None if more data is needed"""
+        while True:
+            if self._state in (START_LINE, HEADERS, CHUNK_SIZE, CHUNK_END, TRAILERS):
+                line = self._readline()
+                if line is None:
+                    return None
+                if self._state == START_LINE:
+                    # tolerate empty lines between messages
+                    if line not in (b"\r\n", b"\n"):
+                        self._parse_start_line(line)
+                        self._state = HEADERS
+                elif self._state == HEADERS:
+                    if line in (b"\r\n", b"\n"):
+                        message = self._end_of_headers()
+                        if message is not None:
+                            return message
+                    else:
+                        self._parse_header(line)
+                elif self._state == CHUNK_SIZE:
+                    self._remaining = int(line.split(b";", 1)[0].strip(), 16)
+                    self._state = CHUNK_DATA if self._remaining else TRAILERS
+                elif self._state == CHUNK_END:
+                    self._state = CHUNK_SIZE
+                elif line in (b"\r\n", b"\n"):
+                    # end of the trailers after the last chunk
+                    return self._emit()
+            elif self._state in (BODY, CHUNK_DATA):
+                available = len(self.buffer) - self._pos
+                if available < self._remaining:
+                    return None
+                self._pos += self._remaining
+                self._remaining = 0
+                if self._state == BODY:
+                    return self._emit()
+                self._state = CHUNK_END
+            else:
+                return None
+
+    def feed_eof(self):
+        """Returns what is left in the buffer when the peer closes the connection"""
+        self._pos = len(self.buffer)
+        return self._emit() if self.buffer else None
+
+
+class MessageReader():
+    """
+    Persistent per-socket reader: data is received with recv_into in a
+    preallocated buffer and framed by a TCPFramer or an HTTPFramer.
+    receive() returns one message at a time, b"" when the connection is closed.
+    """
+    def __init__(self, sock: socket.socket, http: bool, request_methods: deque = None, verbose=False):
+        self.sock = sock
+        self.framer = HTTPFramer(request_methods) if http else TCPFramer()
+        self.verbose = verbose
+        self._chunk = bytearray(RECV_SIZE)
+        self._view = memoryview(self._chunk)
+        self._ready = None
+        self._closed = False
+
+    def receive(self) -> bytes:
+        if self._ready is not None:
+            message, self._ready = self._ready, None
+            return message
+        try:
+            while not self._closed:
+                message = self.framer.next_message()
+                if message is not None:
+                    return message
+                received = self.sock.recv_into(self._chunk)
+                if not received:
+                    self._closed = True
+                    return self.framer.feed_eof() or b""
+                self.framer.feed(self._view[:received])
+        except (FramingError, ValueError) as e:
+            if self.verbose:
+                print(str(e))
+            self._closed = True
+        return b""
+
+    def frame_as_tcp(self):
+        """Relays the following data as it is received, keeping the bytes already buffered"""
+        if isinstance(self.framer, HTTPFramer):
+            framer = TCPFramer()
+            framer.feed(self.framer.buffer)
+            self.framer = framer
+
+    def pending(self) -> bool:
+        """True if a message can be received without waiting for the socket to be readable"""
+        if self._ready is None and not self._closed:
+            try:
+                self._ready = self.framer.next_message()
+            except (FramingError, ValueError):
+                return True
+        return (self._ready is not None or
+                isinstance(self.sock, ssl.SSLSocket) and self.sock.pending() > 0)
+
+    def buffered(self) -> bool:
+        """True if some received bytes have not been returned yet"""
+        return self._ready is not None or len(self.framer.buffer) > 0
@@ -0,0 +1,210 @@
+import importlib.util
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+from time import perf_counter_ns
+from src.stream import TCPStream, HTTPStream
+
+# the shared memory segment of a thread starts at this size and doubles when needed
+MIN_SEGMENT_SIZE = 1 << 20
+# segments kept attached by each worker process
+MAX_ATTACHED_SEGMENTS = 64
+# how often workers check that the service process is still alive
+PARENT_CHECK_TIME = 1
+
+
+################################################################################
+# service process side
+
+class HeavyFilterPool():
+    """
+    Worker processes of a service running the filters marked as CPU heavy,
+    so they are not serialized by the GIL of the service process.
+
+    The messages of the stream are copied in a shared memory segment owned by
+    the calling thread and reused for all its messages: only the name of the
+    segment and the message lengths are pickled.
+    """
+    def __init__(self, workers: int = None):
+        self.workers = workers or os.cpu_count()
+        self._executor = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # workers are spawned: forking a process with running threads is not safe
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                                     initializer=watch_parent, initargs=(os.getpid(),))
+            return self._executor
+
+    def _get_segment(self, size: int) -> shared_memory.SharedMemory:
+        segment = getattr(self._local, "segment", None)
+        if segment is None or segment.shm.size < size:
+            new_size = max(MIN_SEGMENT_SIZE, segment.shm.size if segment else 0)
+            while new_size < size:
+                new_size *= 2
+            # the previous segment is unlinked when it is garbage collected
+            segment = self._local.segment = _Segment(new_size)
+        return segment.shm
+
+    def run(self, chain, names: tuple, stream):
+        """
+        Runs the filters `names` of the chain, in order, in a worker process.
+        Returns (attack, rewritten message or None, elapsed ns of each filter run, traceback or None).
+        """
+        messages = (stream.current_message, *stream.previous_messages)
+        lengths = tuple(len(message) for message in messages)
+        shm = self._get_segment(sum(lengths))
+        position = 0
+        for message, length in zip(messages, lengths):
+            shm.buf[position:position + length] = message
+            position += length
+
+        try:
+            future = self._get_executor().submit(
+                evaluate, shm.name, lengths, getattr(stream, "decompression_limits", None), stream.previous_messages.maxlen,
+                stream._max_message_size, chain.module_path, chain.module_version, chain.module_source, names)
+            return future.result()
+        except BrokenProcessPool:
+            # a worker died (e.g. killed by the OOM killer): start a new pool for the next messages
+            with self._lock:
+                self._executor = None
+            raise
+
+
+class _Segment():
+    """Shared memory owned by a thread, unlinked when the thread ends"""
+    def __init__(self, size: int):
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+
+    def __del__(self):
+        try:
+            self.shm.close()
+            self.shm.unlink()
+        except (BufferError, FileNotFoundError):
+            pass
+
+
+class HeavyGroup():
+    """Consecutive CPU heavy filters of a chain, evaluated with a single round trip to the workers"""
+    def __init__(self, names: tuple, counters: tuple):
+        self.names = names
+        self.counters = counters
+
+    def execute(self, chain, stream):
+        attack, rewritten, timings, error = pool.run(chain, self.names, stream)
+        if rewritten is not None:
+            stream.current_message = rewritten
+        last = len(timings) - 1
+        for index, (counter, elapsed_ns) in enumerate(zip(self.counters, timings)):
+            counter.record(elapsed_ns, attack and index == last)
+        if error:
+            self.counters[last].errors += 1
+            raise RuntimeError(f"Filter {self.names[last]} failed in the worker process:\n{error}")
+        return attack
+
+
+# the service process runs a single service
+pool = HeavyFilterPool()
+
+
+def configure(workers: int = None):
+    global pool
+    pool = HeavyFilterPool(workers)
+
+
+################################################################################
+# worker process side
+
+_segments = OrderedDict()
+_modules = {}
+
+
+def watch_parent(parent_pid: int):
+    """Workers exit with the service process, also when it is killed"""
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(PARENT_CHECK_TIME)
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    shm = _segments.get(name)
+    if shm is None:
+        # the resource tracker is shared with the service process, which owns
+        # and unlinks the segment: attaching doesn't need any cleanup
+        shm = _segments[name] = shared_memory.SharedMemory(name=name)
+        if len(_segments) > MAX_ATTACHED_SEGMENTS:
+            _, oldest = _segments.popitem(last=False)
+            oldest.close()
+    else:
+        _segments.move_to_end(name)
+    return shm
+
+
+def _load_module(path: str, version: int, source: bytes):
+    """
+    Module instance of the filter module, reloaded when the service process
+    loads a new version. The source is the one the service process validated,
+    the file may already hold a newer version.
+    """
+    cached = _modules.get(path)
+    if cached is None or cached[0] != version:
+        module_name = os.path.splitext(os.path.basename(path))[0]
+        spec = importlib.util.spec_from_file_location(module_name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = module
+        exec(compile(source, path, "exec"), module.__dict__)
+        cached = _modules[path] = (version, module.Module())
+    return cached[1]
+
+
+def evaluate(shm_name: str, lengths: tuple, decompression_limits: tuple, max_stored_messages: int, max_message_size: int,
+             module_path: str, module_version: int, module_source: bytes, names: tuple):
+    """Runs in a worker process, see HeavyFilterPool.run"""
+    buffer = _attach(shm_name).buf
+    messages = []
+    position = 0
+    for length in lengths:
+        messages.append(bytes(buffer[position:position + length]))
+        position += length
+
+    if decompression_limits is None:
+        stream = TCPStream(max_stored_messages, max_message_size)
+    else:
+        stream = HTTPStream(max_stored_messages, max_message_size, *decompression_limits)
+    stream.restore(messages[0], messages[1:])
+    module = _load_module(module_path, module_version, module_source)
+
+    attack = None
+    error = None
+    timings = []
+    for name in names:
+        start = perf_counter_ns()
+        try:
+            result = getattr(module, name)(stream)
+        except IndexError:
+            result = False
+        except Exception:
+            result = False
+            error = traceback.format_exc()
+        timings.append(perf_counter_ns() - start)
+        if error:
+            break
+        if result:
+            attack = result if isinstance(result, str) else name
+            break
+
+    rewritten = stream.current_message if stream.current_message is not messages[0] else None
+    return attack, rewritten, timings, error
@@ -1,79 +1,193 @@
 from http_parser.pyparser import HttpParser
 import json
 from urllib.parse import parse_qsl
-from dataclasses import dataclass
+import zlib
+from functools import cached_property
+from collections import deque
+
+# limits of the decompressed HTTP bodies
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+MAX_DECOMPRESSION_RATIO = 100
+# zlib window bits of the supported Content-Encoding values
+ENCODINGS = {"gzip": 16 + zlib.MAX_WBITS, "x-gzip": 16 + zlib.MAX_WBITS, "deflate": zlib.MAX_WBITS}
+
+
+def decompress(body: bytes, wbits: int, max_size: int):
+    """
+    Decompresses at most max_size bytes of body.
+    Returns (decompressed body, True if the decompressed body is longer than max_size)
+    """
+    try:
+        decompressor = zlib.decompressobj(wbits)
+        data = decompressor.decompress(body, max_size + 1)
+    except zlib.error:
+        if wbits != zlib.MAX_WBITS:
+            raise
+        # some servers send raw deflate data without the zlib header
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        data = decompressor.decompress(body, max_size + 1)
+    if len(data) > max_size:
+        return data[:max_size], True
+    return data, False
+
+
+def parse_query_string(raw_string, parameters: dict):
+    for key,value in parse_qsl(raw_string):
+        try:
+            key = key.decode()
+            value = value.decode()
+        except:
+            pass
+        if parameters.get(key):
+            if isinstance(parameters[key], list):
+                parameters[key].append(value)
+            else:
+                parameters[key] = [parameters[key], value]
+        else:
+            parameters[key] = value
+
+
+def parse_parameters(method: str, headers, query_string: str, body: bytes):
+    """Parameters of the query string or of the body of POST requests"""
+    parameters = {}
+    if method == "POST":
+        if len(body) == 0:
+            return parameters
+        content_type = headers.get("Content-Type")
+        if not content_type or "x-www-form-urlencoded" in content_type:
+            try:
+                parse_query_string(body.decode(), parameters)
+            except:
+                pass
+        elif "json" in content_type:
+            parameters = json.loads(body)
+    elif method == "GET":
+        parse_query_string(query_string, parameters)
+    return parameters
+
 
-@dataclass
 class HttpMessage():
-    fragment: str
-    headers: dict
-    method: str
-    parameters: dict
-    path: str
-    query_string: str
-    raw_body: bytes
-    status_code: int
-    url: str
-    version: str
+    """
+    HTTP message parsed by HttpMessageParser.
 
-class HttpMessageParser(HttpParser):
-    def __init__(self, data:bytes, decompress_body=True):
-        super().__init__(decompress = decompress_body)
-        self.execute(data, len(data))
-        self._parameters = {}
+    raw_body and parameters are computed on first access: compressed bodies
+    (gzip, deflate) are decompressed only if a filter reads them, and at
+    most min(max_decompressed_size, max_decompression_ratio * compressed
+    size) bytes are decompressed. When the limit is exceeded raw_body is
+    truncated and oversized is set.
+    """
+    def __init__(self, fragment: str, headers: dict, method: str, path: str, query_string: str, body: bytes,
+                 status_code: int, url: str, version: str, max_decompressed_size: int = MAX_DECOMPRESSED_SIZE,
+                 max_decompression_ratio: float = MAX_DECOMPRESSION_RATIO):
+        self.fragment = fragment
+        self.headers = headers
+        self.method = method
+        self.path = path
+        self.query_string = query_string
+        self.status_code = status_code
+        self.url = url
+        self.version = version
+        self._body = body
+        self._max_decompressed_size = max_decompressed_size
+        self._max_decompression_ratio = max_decompression_ratio
+        self._oversized = False
+
+    @cached_property
+    def raw_body(self) -> bytes:
+        wbits = ENCODINGS.get((self.headers.get("Content-Encoding") or "").strip().lower())
+        if wbits is None or not self._body:
+            return self._body
+        max_size = int(min(self._max_decompressed_size, self._max_decompression_ratio * len(self._body)))
         try:
-            self._parse_parameters()
+            body, self._oversized = decompress(self._body, wbits, max_size)
+        except zlib.error as e:
+            print("Error in body decompression:", str(e))
+            return self._body
+        return body
+
+    @property
+    def oversized(self) -> bool:
+        """True if the decompressed body exceeds the limits (the body is decompressed if needed)"""
+        self.raw_body
+        return self._oversized
+
+    @cached_property
+    def parameters(self) -> dict:
+        """parameters parsed from query string or body"""
+        try:
+            return parse_parameters(self.method, self.headers, self.query_string, self.raw_body)
         except Exception as e:
-            print("Error in parameters parsing:", data)
+            print("Error in parameters parsing:", self.url)
             print("Exception:", str(e))
+            return {}
+
+    def __repr__(self):
+        return f"HttpMessage(method={self.method!r}, url={self.url!r}, status_code={self.status_code!r}, headers={self.headers!r})"
+
+
+class HttpMessageParser(HttpParser):
+    """
+    Parses a raw HTTP message. Bodies are decompressed by the parser only with
+    decompress_body=True, otherwise lazily by HttpMessage with bounded size.
+    """
+    def __init__(self, data:bytes, decompress_body=False):
+        super().__init__(decompress = decompress_body)
+        self.execute(data, len(data))
 
     def get_raw_body(self):
         return b"\r\n".join(self._body)
-    
-    def _parse_query_string(self, raw_string):
-        parameters = parse_qsl(raw_string)
-        for key,value in parameters:
-            try:
-                key = key.decode()
-                value = value.decode()
-            except:
-                pass
-            if self._parameters.get(key):
-                if isinstance(self._parameters[key], list):
-                    self._parameters[key].append(value)
-                else:
-                    self._parameters[key] = [self._parameters[key], value]
-            else:
-                self._parameters[key] = value
-
-    def _parse_parameters(self):
-        if self._method == "POST":
-            body = self.get_raw_body()
-            if len(body) == 0:
-                return
-            content_type = self.get_headers().get("Content-Type")
-            if not content_type or "x-www-form-urlencoded" in content_type:
-                try:
-                    self._parse_query_string(body.decode())
-                except:
-                    pass
-            elif "json" in content_type:
-                self._parameters = json.loads(body)
-        elif self._method == "GET":
-            self._parse_query_string(self._query_string)
-        
+
     def get_parameters(self):
         """returns parameters parsed from query string or body"""
-        return self._parameters
-    
+        try:
+            return parse_parameters(self._method, self.get_headers(), self._query_string, self.get_raw_body())
+        except Exception as e:
+            print("Error in parameters parsing:", self._url)
+            print("Exception:", str(e))
+            return {}
+
     def get_version(self):
         if self._version:
             return ".".join([str(x) for x in self._version])
         return None
 
-    def to_message(self):
+    def to_message(self, max_decompressed_size: int = MAX_DECOMPRESSED_SIZE,
+                   max_decompression_ratio: float = MAX_DECOMPRESSION_RATIO):
+        # the body is still compressed: a single stream
+        body = b"".join(self._body) if not self.decompress and self._headers.get("Content-Encoding") else self.get_raw_body()
         return HttpMessage(self._fragment, self._headers, self._method,
-                           self._parameters, self._path, self._query_string,
-                           self.get_raw_body(), self._status_code,
-                           self._url, self.get_version()
-                           )
\ No newline at end of file
+                           self._path, self._query_string, body,
+                           self._status_code, self._url, self.get_version(),
+                           max_decompressed_size, max_decompression_ratio
+                           )
+
+
+class LazyHttpMessage():
+    """Raw HTTP message, parsed only the first time it is accessed"""
+    __slots__ = ("raw", "limits", "_message", "_parsed")
+
+    def __init__(self, raw: bytes, limits: tuple = ()):
+        self.raw = raw
+        # max_decompressed_size, max_decompression_ratio
+        self.limits = limits
+        self._message = None
+        self._parsed = False
+
+    @property
+    def message(self) -> HttpMessage:
+        if not self._parsed:
+            self._parsed = True
+            try:
+                self._message = HttpMessageParser(self.raw).to_message(*self.limits)
+            except Exception as e:
+                print("Error in HTTP parsing:", str(e))
+        return self._message
+
+
+class LazyHttpMessages(deque):
+    """deque of LazyHttpMessage, items are returned already parsed as HttpMessage"""
+    def __getitem__(self, index) -> HttpMessage:
+        return super().__getitem__(index).message
+
+    def __iter__(self):
+        return (lazy.message for lazy in super().__iter__())
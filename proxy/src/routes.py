@@ -0,0 +1,88 @@
+import posixpath
+import re
+from urllib.parse import unquote
+
+SLASHES = re.compile(r"/{2,}")
+# scheme://authority of an absolute-form request target (GET http://host/path HTTP/1.1)
+ABSOLUTE_FORM = re.compile(r"[A-Za-z][A-Za-z0-9+.-]*://[^/]*")
+
+
+def request_line(stream):
+    """
+    Method and path of the request the current message belongs to: the
+    current message itself, or for responses the latest request of the stream.
+    Only the request line is read, the message is not parsed.
+    """
+    raw = stream.current_message
+    if raw.startswith(b"HTTP/"):
+        raw = next((message for message in stream.previous_messages
+                    if message and not message.startswith(b"HTTP/")), b"")
+    line = raw[:raw.find(b"\n")].split(b" ", 2)
+    if len(line) < 3 or not line[2].startswith(b"HTTP/"):
+        return None, None
+    method = line[0].decode(errors="replace").upper()
+    target = line[1].split(b"?", 1)[0].decode(errors="replace")
+    absolute = ABSOLUTE_FORM.match(target)
+    if absolute:
+        target = target[absolute.end():] or "/"
+    path = unquote(target)
+    # /a/../register and //register reach the same handler as /register
+    normalized = posixpath.normpath(SLASHES.sub("/", path)) if path.startswith("/") else path
+    if path.endswith("/") and not normalized.endswith("/"):
+        normalized += "/"
+    return method, normalized
+
+
+class RouteIndex():
+    """
+    Index of the filters decorated with @route.
+
+    routes: {filter_name: (methods, paths, patterns)}
+
+    Path prefixes are stored in a character trie, so the filters matching a
+    path are found by walking the path once whatever the number of routes;
+    patterns are regexes searched on the path.
+    """
+    def __init__(self, routes: dict):
+        self.routed = frozenset(routes)
+        self.methods = {}
+        self.trie = {}
+        self.patterns = []
+        for name, (methods, paths, patterns) in routes.items():
+            self.methods[name] = frozenset(method.upper() for method in methods) if methods else None
+            if not paths and not patterns:
+                # only the method is filtered
+                paths = ("",)
+            for prefix in paths or ():
+                node = self.trie
+                for character in prefix:
+                    node = node.setdefault(character, {})
+                node.setdefault(None, []).append(name)
+            for pattern in patterns or ():
+                self.patterns.append((re.compile(pattern), name))
+
+    def __bool__(self):
+        return bool(self.routed)
+
+    def matching(self, method: str, path: str) -> set:
+        names = set()
+        node = self.trie
+        names.update(node.get(None, ()))
+        for character in path:
+            node = node.get(character)
+            if node is None:
+                break
+            names.update(node.get(None, ()))
+        for pattern, name in self.patterns:
+            if name not in names and pattern.search(path):
+                names.add(name)
+        return {name for name in names if self.methods[name] is None or method in self.methods[name]}
+
+    def skipped(self, stream) -> frozenset:
+        """Names of the routed filters that don't match the request of the current message"""
+        method, path = request_line(stream)
+        if method is None or not path.startswith("/"):
+            # not an HTTP request line or not a path (CONNECT host:port,
+            # OPTIONS *, ...): run all the filters
+            return frozenset()
+        return self.routed - self.matching(method, path)
@@ -0,0 +1,110 @@
+import json
+import os
+import re
+from src.constants import MODULES_PATH
+
+# fields of a message the rules can be applied to
+BYTES_FIELDS = ("raw", "body")
+TEXT_FIELDS = ("path", "header", "parameter")
+FIELDS = BYTES_FIELDS + TEXT_FIELDS
+DIRECTIONS = ("in", "out")
+GLOBAL_FLAGS = re.compile(r"^\(\?([aiLmsux]+)\)")
+# \1 or (?(1)...), groups are renumbered in the single regex of the field;
+# other escapes are consumed (captured) so \\1 is not a reference
+NUMBERED_REFERENCE = re.compile(r"\\(?:[1-9]|(.))|\(\?\(\d", re.DOTALL)
+
+
+def get_rules_path(service_name):
+    return os.path.join(MODULES_PATH, service_name, service_name + "_rules.json")
+
+
+class RuleSet():
+    """
+    Named regexes of a direction, compiled into a single alternation per
+    field so each field is scanned once whatever the number of rules.
+
+    rules: {field: {rule_name: regex}}
+    """
+    def __init__(self, rules: dict):
+        self.fields = {}
+        for field, field_rules in rules.items():
+            if field not in FIELDS:
+                raise ValueError(f"Unknown rules field '{field}', expected one of {FIELDS}")
+            if field_rules:
+                self.fields[field] = self._compile(field, field_rules)
+
+    @staticmethod
+    def _compile(field, field_rules: dict):
+        alternatives = []
+        names = {}
+        flags = re.DOTALL if field in BYTES_FIELDS else re.MULTILINE
+        # named groups of all the rules share the single regex
+        group_owners = {f"rule{index}": None for index in range(len(field_rules))}
+        for index, (name, pattern) in enumerate(field_rules.items()):
+            try:
+                compiled = re.compile(pattern.encode() if field in BYTES_FIELDS else pattern, flags)
+            except re.error as e:
+                raise ValueError(f"Invalid regex for rule '{name}': {e}")
+            if any(reference.group(1) is None for reference in NUMBERED_REFERENCE.finditer(pattern)):
+                raise ValueError(f"Rule '{name}' uses a numbered group reference, use a named group instead")
+            for group in compiled.groupindex:
+                if group in group_owners:
+                    owner = group_owners[group]
+                    raise ValueError(f"Group name '{group}' of rule '{name}' is "
+                                     + (f"already used by rule '{owner}'" if owner else "reserved"))
+                group_owners[group] = name
+            # global inline flags like (?i) are only allowed at the start of the whole regex
+            global_flags = GLOBAL_FLAGS.match(pattern)
+            if global_flags:
+                pattern = f"(?{global_flags.group(1)}:{pattern[global_flags.end():]})"
+            group = f"rule{index}"
+            names[group] = name
+            alternatives.append(f"(?P<{group}>{pattern})")
+        regex = "|".join(alternatives)
+        if field in BYTES_FIELDS:
+            return re.compile(regex.encode(), flags), names
+        return re.compile(regex, flags), names
+
+    def __bool__(self):
+        return bool(self.fields)
+
+    def _field_value(self, field, stream):
+        if field == "raw":
+            return stream.current_message
+        message = getattr(stream, "current_http_message", None)
+        if message is None:
+            return None
+        if field == "body":
+            return message.raw_body
+        if field == "path":
+            return message.path
+        if field == "header":
+            return "\n".join(f"{name}: {value}" for name, value in message.headers.items())
+        return "\n".join(f"{name}={value}" for name, value in message.parameters.items())
+
+    def match(self, stream):
+        """Returns the name of the first rule matching the current message, None otherwise"""
+        for field, (regex, names) in self.fields.items():
+            value = self._field_value(field, stream)
+            if value:
+                match = regex.search(value)
+                if match:
+                    return names[match.lastgroup]
+        return None
+
+
+def load_rules(service_name):
+    """
+    Loads filter_modules/<service>/<service>_rules.json, formatted as
+    {"in": {field: {rule_name: regex}}, "out": {...}}.
+    Returns the in and out RuleSet, empty if the file doesn't exist.
+    """
+    try:
+        with open(get_rules_path(service_name)) as f:
+            rules = json.load(f)
+    except FileNotFoundError:
+        rules = {}
+    for direction in rules:
+        if direction not in DIRECTIONS:
+            raise ValueError(f"Unknown rules direction '{direction}', expected one of {DIRECTIONS}")
+    return RuleSet(rules.get("in", {})), RuleSet(rules.get("out", {}))
@@ -6,35 +6,50 @@ import time
 import select
 import errno
 from watchdog.observers import Observer
-from src.filter_modules import import_modules
+from src.filter_modules import load_filter_set
 from src.classes import ModuleWatchdog, Service
 from src.stream import TCPStream, HTTPStream
+from src.http_parsing import MAX_DECOMPRESSED_SIZE, MAX_DECOMPRESSION_RATIO
 import src.constants as constants
 import os
 import src.utils as utils
 import src.ssl_utils as ssl_utils
+import src.async_relay as async_relay
+import src.filter_stats as filter_stats
+import src.heavy_filters as heavy_filters
+from src.filter_budget import FilterBudget
+from src.flag_scanner import FlagScanner
+from src.zero_copy import SplicePipe, SPLICE_SUPPORTED
+from src.framing import MessageReader
+from collections import deque
 
-def get_address_family(host):
-    try:
-        result = socket.getaddrinfo(host, 0, socket.AF_UNSPEC, socket.SOCK_STREAM)
-        return result[0][0]
-    except socket.gaierror as e:
-        print(f"Error resolving host: {e}")
-        return None
+def service_function(service: Service, global_config, count, stats_queue=None):
+    if stats_queue is not None:
+        filter_stats.reporter(stats_queue, constants.LOG_REFRESH_TIME)
+    # worker processes for the CPU heavy filters, started on first use
+    heavy_filters.configure(service.heavy_workers)
 
-def service_function(service: Service, global_config, count):
-    in_module, out_module = import_modules(service.name, False)
+    chain_options = {"verdict_cache": service.verdict_cache, "adaptive_order": service.adaptive_order}
+    try:
+        filter_set = load_filter_set(service.name, http=service.http, **chain_options)
+    except Exception as e:
+        print('Modules of %s can\'t be loaded' % service.name)
+        print(str(e))
+        sys.exit(3)
 
     # this event handler will reload modules on changes
-    watchdog_handler = ModuleWatchdog(regexes=[f".*{service.name}.*\.py"], in_module=in_module,
-                                    out_module=out_module, name=service.name)
+    watchdog_handler = ModuleWatchdog(regexes=[f".*{service.name}.*\.py", f".*{service.name}_rules\.json"], filter_set=filter_set,
+                                    name=service.name, http=service.http, chain_options=chain_options)
     observer = Observer()
     observer.schedule(watchdog_handler, path=os.path.join(constants.MODULES_PATH, service.name), recursive=False)
     observer.start()
 
     # this is the socket we will listen on for incoming connections
-    proxy_socket = socket.socket(get_address_family(service.listen_ip), socket.SOCK_STREAM)
+    proxy_socket = socket.socket(utils.get_address_family(service.listen_ip), socket.SOCK_STREAM)
     proxy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if service.workers > 1:
+        # every worker binds the same address, the kernel spreads connections among them
+        proxy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
     try:
         proxy_socket.bind((service.listen_ip, service.listen_port))
     except socket.error as e:
@@ -43,6 +58,20 @@ def service_function(service: Service, global_config, count):
     proxy_socket.listen(100)
     utils.vprint(service.__dict__, global_config["verbose"])
 
+    budget = None
+    if service.filter_timeout:
+        budget = FilterBudget(service.name, service.filter_timeout, service.timeout_policy, service.max_overruns)
+    flag_scanner = None
+    if service.scan_flags:
+        flag_scanner = FlagScanner.from_config(service.name, global_config.get("flag_scanner"))
+
+    if service.relay == "asyncio":
+        async_relay.serve(proxy_socket, service, global_config, watchdog_handler, count, budget, flag_scanner)
+        utils.vprint('Ctrl+C detected, exiting...', global_config["verbose"])
+        observer.stop()
+        observer.join()
+        sys.exit(0)
+
     # endless loop until ctrl+c
     try:
         while True:
@@ -51,7 +80,7 @@ def service_function(service: Service, global_config, count):
             proxy_thread = threading.Thread(target=connection_thread,
                                             args=(
                                                 in_socket, service, global_config,
-                                                watchdog_handler, count
+                                                watchdog_handler, count, budget, flag_scanner
                                             ))
             utils.vprint("Starting proxy thread " +
                          proxy_thread.name, global_config["verbose"])
@@ -64,11 +93,12 @@ def service_function(service: Service, global_config, count):
         sys.exit(0)
 
 
-def connection_thread(local_socket: socket.socket, service: Service, global_config: dict, watchdog_handler, count):
+def connection_thread(local_socket: socket.socket, service: Service, global_config: dict, watchdog_handler, count, budget=None, flag_scanner=None):
     """This method is executed in a thread. It will relay data between the local
     host and the remote host, while letting modules work on the data before
     passing it on."""
-    remote_socket = socket.socket(get_address_family(service.target_ip))
+    filter_packet = budget.filter_packet if budget else utils.filter_packet
+    remote_socket = socket.socket(utils.get_address_family(service.target_ip))
 
     try:
         remote_socket.connect((service.target_ip, service.target_port))
@@ -94,19 +124,37 @@ def connection_thread(local_socket: socket.socket, service: Service, global_conf
     # This loop ends when no more data is received on either the local or the
     # remote socket
     if service.http:
-        stream = HTTPStream(global_config["max_stored_messages"], global_config["max_message_size"]) 
+        stream = HTTPStream(global_config["max_stored_messages"], global_config["max_message_size"],
+                            global_config.get("max_decompressed_size", MAX_DECOMPRESSED_SIZE),
+                            global_config.get("max_decompression_ratio", MAX_DECOMPRESSION_RATIO))
     else:
         stream = TCPStream(global_config["max_stored_messages"], global_config["max_message_size"])
 
+    # directions without filters are spliced kernel-side, SSL data can't be spliced
+    zero_copy = service.zero_copy and SPLICE_SUPPORTED and not service.ssl
+    splice_pipe = None
+    # last bytes sent by the service, to find the flags split between two messages
+    flag_tail = b""
+
+    # persistent readers keep the bytes received after a message for the next one
+    request_methods = deque()
+    readers = {sock: MessageReader(sock, service.http, request_methods, global_config["verbose"])
+               for sock in [remote_socket, local_socket]}
+
     connection_open = True
     while connection_open:
-        ready_sockets, _, _ = select.select(
-            [remote_socket, local_socket], [], [])
+        # messages already buffered by the readers don't wake up select
+        ready_sockets = [sock for sock in [remote_socket, local_socket] if readers[sock].pending()]
+        if not ready_sockets:
+            ready_sockets, _, _ = select.select(
+                [remote_socket, local_socket], [], [])
         if ssl_utils.start_tls(service.ssl, local_socket, ready_sockets):
             try:
                 ssl_sockets = ssl_utils.enable_ssl(
                     service.ssl, remote_socket, local_socket)
                 remote_socket, local_socket = ssl_sockets
+                readers = {sock: MessageReader(sock, service.http, request_methods, global_config["verbose"])
+                           for sock in ssl_sockets}
                 utils.vprint("SSL enabled", global_config["verbose"])
             except ssl.SSLError as e:
                 if e.reason != "SSLV3_ALERT_CERTIFICATE_UNKNOWN":
@@ -131,8 +179,33 @@ def connection_thread(local_socket: socket.socket, service: Service, global_conf
                         f"{time.strftime('%Y%m%d-%H%M%S')}: Socket exception in connection_thread")
                     raise serr
 
+            # the chains of a single version are used for the whole message
+            filters = watchdog_handler.filters
+            if (zero_copy and not readers[sock].buffered() and
+                    not (filters.in_filtered if sock == local_socket else filters.out_filtered or flag_scanner)):
+                if splice_pipe is None:
+                    splice_pipe = SplicePipe()
+                if service.http and sock == local_socket:
+                    # the methods of the spliced requests are unknown, so the responses
+                    # can't be framed anymore (responses to HEAD have no body)
+                    readers[remote_socket].frame_as_tcp()
+                    readers[local_socket].framer.request_methods = deque(maxlen=0)
+                try:
+                    destination = remote_socket if sock == local_socket else local_socket
+                    spliced = splice_pipe.transfer(sock, destination)
+                except OSError:
+                    spliced = 0
+                if not spliced:
+                    utils.vprint(f"Connection from {peer[0]},{peer[1]} closed", global_config["verbose"])
+                    remote_socket.close()
+                    local_socket.close()
+                    connection_open = False
+                    break
+                utils.vprint('Spliced %d bytes' % spliced, global_config["verbose"])
+                continue
+
             try:
-                stream.set_current_message(utils.receive_from(sock, service.http, global_config["verbose"]))
+                stream.set_current_message(readers[sock].receive())
             except socket.error as serr:
                 utils.vprint(
                     f"{time.strftime('%Y%m%d-%H%M%S')}: Socket exception in connection_thread: connection reset by local or remote host")
@@ -154,7 +227,7 @@ def connection_thread(local_socket: socket.socket, service: Service, global_conf
                     break
 
                 utils.vprint(b'> > > in\n' + stream.current_message, global_config["verbose"])
-                attack = utils.filter_packet(stream, watchdog_handler.in_module)
+                attack = filter_packet(stream, filters.in_chain)
                 if not attack:
                     remote_socket.send(stream.current_message)
             else:
@@ -166,15 +239,25 @@ def connection_thread(local_socket: socket.socket, service: Service, global_conf
                     connection_open = False
                     break
 
+                if isinstance(remote_socket, ssl.SSLSocket):
+                    # TLS 1.3 session tickets are received after the handshake
+                    ssl_utils.remember_session(remote_socket)
+
                 utils.vprint(b'< < < out\n' + stream.current_message, global_config["verbose"])
-                attack = utils.filter_packet(stream, watchdog_handler.out_module)
+                attack = filter_packet(stream, filters.out_chain)
+                if not attack and flag_scanner:
+                    attack, flag_tail = flag_scanner.check(flag_tail, stream.current_message)
                 if not attack:
                     local_socket.send(stream.current_message)
 
             if attack:
                 utils.vprint(f"Connection {peer[0]},{peer[1]} BLOCKED", global_config["verbose"])
-                count.value += 1
+                with count.get_lock():
+                    count.value += 1
                 block_answer = global_config["keyword"] + " " + service.name + " " + attack
-                utils.block_packet(local_socket, get_address_family(service.listen_ip), remote_socket, block_answer, global_config.get("dos", None))
+                utils.block_packet(local_socket, utils.get_address_family(service.listen_ip), remote_socket, block_answer, global_config.get("dos", None))
                 connection_open = False
                 break
+
+    if splice_pipe is not None:
+        splice_pipe.close()
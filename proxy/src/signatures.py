@@ -0,0 +1,112 @@
+import re
+import threading
+
+try:
+    # C implementation of Aho-Corasick, used when installed
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+
+def _to_bytes(pattern) -> bytes:
+    return pattern.encode() if isinstance(pattern, str) else bytes(pattern)
+
+
+class _AhoCorasickMatcher():
+    def __init__(self, patterns: dict):
+        self.automaton = ahocorasick.Automaton()
+        for pattern, name in patterns.items():
+            # the automaton works on str: latin-1 maps every byte to one character
+            self.automaton.add_word(pattern.decode("latin-1"), name)
+        self.automaton.make_automaton()
+
+    def search(self, data: bytes):
+        for _, name in self.automaton.iter(data.decode("latin-1")):
+            return name
+        return None
+
+
+class _TrieRegexMatcher():
+    """Fallback: the patterns are merged in a trie and compiled as a single regex"""
+    def __init__(self, patterns: dict):
+        self.names = patterns
+        trie = {}
+        for pattern in patterns:
+            node = trie
+            for byte in pattern:
+                node = node.setdefault(byte, {})
+            node[None] = True
+        self.regex = re.compile(self._trie_regex(trie), re.DOTALL)
+
+    def _trie_regex(self, node) -> bytes:
+        alternatives = [re.escape(bytes([byte])) + self._trie_regex(child)
+                        for byte, child in sorted(item for item in node.items() if item[0] is not None)]
+        if not alternatives:
+            return b""
+        optional = None in node
+        if len(alternatives) == 1 and not optional:
+            return alternatives[0]
+        return b"(?:" + b"|".join(alternatives) + b")" + (b"?" if optional else b"")
+
+    def search(self, data: bytes):
+        match = self.regex.search(data)
+        return self.names[match.group()] if match else None
+
+
+class SignatureSet():
+    """
+    Searches many byte patterns in a message with a single pass over it.
+
+    patterns: dict {name: pattern} or list of patterns (the pattern itself is
+    used as name). Patterns can be bytes or str.
+    ignore_case: ASCII case-insensitive matching
+
+    Define it at module level in a filter module, so it is built once every
+    time the module is (re)loaded, and return the result of search() from the
+    filter: the name of the matching pattern becomes the attack name.
+
+        SIGNATURES = SignatureSet({"sqli": b"' or 1=1", "traversal": b"../"}, ignore_case=True)
+
+        def signatures(self, stream: TCPStream):
+            return SIGNATURES.search(stream.current_message)
+    """
+    def __init__(self, patterns=(), ignore_case: bool = False):
+        self.ignore_case = ignore_case
+        self._patterns = {}
+        self._lock = threading.Lock()
+        self._matcher = None
+        if isinstance(patterns, dict):
+            self.update(patterns)
+        else:
+            self.update({_to_bytes(pattern).decode(errors="replace"): pattern for pattern in patterns})
+
+    def add(self, name: str, pattern):
+        self.update({name: pattern})
+
+    def update(self, patterns: dict):
+        """Adds patterns {name: pattern} and rebuilds the automaton, searches in progress are not affected"""
+        with self._lock:
+            merged = dict(self._patterns)
+            for name, pattern in patterns.items():
+                pattern = _to_bytes(pattern)
+                if not pattern:
+                    raise ValueError(f"Empty pattern for signature {name}")
+                if self.ignore_case:
+                    pattern = pattern.lower()
+                # the first name given to a pattern wins
+                merged.setdefault(pattern, name)
+            matcher = (_AhoCorasickMatcher if ahocorasick else _TrieRegexMatcher)(merged) if merged else None
+            self._patterns = merged
+            self._matcher = matcher
+
+    def search(self, data: bytes):
+        """Returns the name of the first pattern found in data, None if no pattern matches"""
+        matcher = self._matcher
+        if matcher is None:
+            return None
+        if self.ignore_case:
+            data = data.lower()
+        return matcher.search(data)
+
+    def __len__(self):
+        return len(self._patterns)
@@ -1,12 +1,13 @@
 
 import ssl
 import socket
-from src.constants import CERTIFICATES_PATH
+from src.constants import CERTIFICATES_PATH, CERTIFICATES_CHECK_TIME
 import os
+import threading
+import time
 
 
-def is_client_hello(sock):
-    firstbytes = sock.recv(128, socket.MSG_PEEK)
+def is_client_hello_bytes(firstbytes):
     return (len(firstbytes) >= 3 and
             firstbytes[0] == 0x16 and
             firstbytes[1:3] in [b"\x03\x00",
@@ -17,47 +18,175 @@ def is_client_hello(sock):
             )
 
 
-def enable_ssl(ssl_config, remote_socket, local_socket):
-    sni = None
+def is_client_hello(sock):
+    firstbytes = sock.recv(128, socket.MSG_PEEK)
+    return is_client_hello_bytes(firstbytes)
 
-    def sni_callback(sock, name, ctx):
-        nonlocal sni
-        sni = name
 
-    try:
-        ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-        ctx.sni_callback = sni_callback
-        ctx.load_cert_chain(certfile=os.path.join(CERTIFICATES_PATH, ssl_config.server_certificate),
-                            keyfile=os.path.join(CERTIFICATES_PATH, ssl_config.server_key)
+def server_context(ssl_config, sni_callback=None):
+    """SSLContext used to terminate TLS coming from the clients"""
+    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ctx.sni_callback = sni_callback
+    ctx.load_cert_chain(certfile=os.path.join(CERTIFICATES_PATH, ssl_config.server_certificate),
+                        keyfile=os.path.join(CERTIFICATES_PATH, ssl_config.server_key)
+                        )
+    if ssl_config.ca_file:
+        ctx.verify_mode = ssl.CERT_REQUIRED
+        ctx.load_verify_locations(cafile=os.path.join(CERTIFICATES_PATH, ssl_config.ca_file))
+    return ctx
+
+
+def client_context(ssl_config):
+    """SSLContext used to open TLS connections towards the service"""
+    ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    if ssl_config.client_certificate and ssl_config.client_key:
+        ctx.load_cert_chain(certfile=os.path.join(CERTIFICATES_PATH, ssl_config.client_certificate),
+                            keyfile=os.path.join(CERTIFICATES_PATH, ssl_config.client_key)
                             )
-        if ssl_config.ca_file:
-            ctx.verify_mode = ssl.CERT_REQUIRED
-            ctx.load_verify_locations(cafile=os.path.join(CERTIFICATES_PATH, ssl_config.ca_file))
-        local_socket = ctx.wrap_socket(local_socket,
-                                       server_side=True,
-                                       suppress_ragged_eofs=True
-                                       )
+    return ctx
+
+
+class ServiceContexts():
+    """
+    SSL contexts of a service, shared by all its connections.
+    Reusing the same contexts lets clients resume their sessions with the
+    proxy (session cache and tickets live in the server context) and lets
+    the proxy resume its sessions with the service.
+    """
+    def __init__(self, ssl_config):
+        self.files = [os.path.join(CERTIFICATES_PATH, file) for file in
+                      (ssl_config.server_certificate, ssl_config.server_key, ssl_config.client_certificate,
+                       ssl_config.client_key, ssl_config.ca_file) if file]
+        self.mtimes = self._get_mtimes()
+        self.checked = time.monotonic()
+        self.server = server_context(ssl_config, _store_sni)
+        self.client = client_context(ssl_config)
+        # latest session established with the service for each SNI
+        self.sessions = {}
+
+    def _get_mtimes(self):
+        mtimes = []
+        for file in self.files:
+            try:
+                mtimes.append(os.stat(file).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def is_outdated(self):
+        now = time.monotonic()
+        if now - self.checked < CERTIFICATES_CHECK_TIME:
+            return False
+        self.checked = now
+        return self._get_mtimes() != self.mtimes
+
+
+_contexts = {}
+_contexts_lock = threading.Lock()
+
+
+def get_contexts(ssl_config) -> ServiceContexts:
+    """Returns the cached contexts of ssl_config, rebuilding them if the certificate files changed"""
+    key = (ssl_config.server_certificate, ssl_config.server_key, ssl_config.client_certificate,
+           ssl_config.client_key, ssl_config.ca_file)
+    contexts = _contexts.get(key)
+    if contexts is None or contexts.is_outdated():
+        with _contexts_lock:
+            # another thread may have rebuilt them in the meantime
+            if _contexts.get(key) is contexts:
+                _contexts[key] = ServiceContexts(ssl_config)
+            contexts = _contexts[key]
+    return contexts
+
+
+def _store_sni(sock, name, ctx):
+    # the callback is shared by all the connections, keep the name on the socket
+    sock.sni = name
+
+
+def resume_session(ssl_object, contexts: ServiceContexts, sni):
+    """
+    Sets on ssl_object (an SSLSocket or SSLObject not connected yet) the latest
+    session established with the service for sni. A session that can't be
+    resumed is dropped and the connection makes a full handshake.
+    """
+    session = contexts.sessions.get(sni)
+    if session is None:
+        return
+    try:
+        ssl_object.session = session
+    except ValueError as e:
+        # e.g. the session refers to the contexts used before the certificates changed
+        print("SSL session not resumed:", str(e))
+        if contexts.sessions.get(sni) is session:
+            contexts.sessions.pop(sni, None)
+
+
+class ResumingContext():
+    """
+    Client context of a connection resuming a session, for the asyncio relay:
+    asyncio has no session argument, but wraps the connection with wrap_bio
+    """
+    def __init__(self, contexts: ServiceContexts, sni):
+        self.contexts = contexts
+        self.sni = sni
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None):
+        ssl_object = self.contexts.client.wrap_bio(incoming, outgoing, server_side, server_hostname)
+        resume_session(ssl_object, self.contexts, self.sni)
+        return ssl_object
+
+
+def client_context_for(contexts: ServiceContexts, sni):
+    """Client context resuming the latest session established with the service for sni, if any"""
+    if sni not in contexts.sessions:
+        return contexts.client
+    return ResumingContext(contexts, sni)
+
+
+def remember_session(remote_socket):
+    """
+    Stores the session of remote_socket (an SSLSocket or, on the asyncio
+    relay, an SSLObject) to resume it on the next connection to the service.
+    The session goes to the contexts that wrapped the socket, which are
+    replaced when the certificates change: sessions of other contexts can't
+    be resumed.
+    """
+    session = remote_socket.session
+    if session is not None:
+        remote_socket.contexts.sessions[getattr(remote_socket, "sni", None)] = session
+
+
+def enable_ssl(ssl_config, remote_socket, local_socket):
+    contexts = get_contexts(ssl_config)
+    try:
+        local_socket = contexts.server.wrap_socket(local_socket,
+                                                   server_side=True,
+                                                   suppress_ragged_eofs=True
+                                                   )
     except ssl.SSLError as e:
         if e.reason != "SSLV3_ALERT_CERTIFICATE_UNKNOWN":
             print("SSL handshake failed for listening socket", str(e))
         raise
 
+    sni = getattr(local_socket, "sni", None)
     try:
-        ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-        ctx.check_hostname = False
-        ctx.verify_mode = ssl.CERT_NONE
-        if ssl_config.client_certificate and ssl_config.client_key:
-            ctx.load_cert_chain(certfile=os.path.join(CERTIFICATES_PATH, ssl_config.client_certificate),
-                                keyfile=os.path.join(CERTIFICATES_PATH, ssl_config.client_key)
-                                )
-        remote_socket = ctx.wrap_socket(remote_socket,
-                                        server_hostname=sni,
-                                        suppress_ragged_eofs=True
-                                        )
+        remote_socket = contexts.client.wrap_socket(remote_socket,
+                                                    server_hostname=sni,
+                                                    suppress_ragged_eofs=True,
+                                                    do_handshake_on_connect=False
+                                                    )
+        remote_socket.sni = sni
+        remote_socket.contexts = contexts
+        resume_session(remote_socket, contexts, sni)
+        remote_socket.do_handshake()
     except ssl.SSLError as e:
         print("SSL handshake failed for remote socket", str(e))
         raise
 
+    remember_session(remote_socket)
     return [remote_socket, local_socket]
 
 
@@ -0,0 +1,229 @@
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from src.constants import STATE_PATH
+from src.singleton import Singleton
+
+MAGIC = b"CTFSTATE"
+# magic, capacity (number of slots)
+HEADER = struct.Struct("<8sQ")
+HEADER_SIZE = 64
+# status, key digest, expiration time (0 = never), value
+SLOT = struct.Struct("<B7x16sdq")
+EMPTY, USED, DELETED = range(3)
+# number of slots of a new state file (40 bytes each)
+DEFAULT_CAPACITY = 1 << 18
+# slots probed before evicting an entry
+MAX_PROBES = 32
+INFINITY = float("inf")
+# slots of the temporary store used by the dry run of the filters
+SCRATCH_CAPACITY = 1024
+
+# store replacing the StateStore in the current thread, see scratch_state
+_scratch = threading.local()
+
+
+def _encode(part) -> bytes:
+    """Type, length and text of a key part, so 1 and "1" (or ("a", "b") and "a\\x00b") are different keys"""
+    if isinstance(part, (bytes, bytearray)):
+        kind, data = b"bytes", bytes(part)
+    else:
+        kind, data = type(part).__name__.encode(), str(part).encode()
+    return b"%s:%d:%s" % (kind, len(data), data)
+
+
+def _digest(*parts) -> bytes:
+    """Keys are stored as 16 bytes digests, so they can have any length"""
+    return hashlib.blake2b(b"".join(_encode(part) for part in parts), digest_size=16).digest()
+
+
+def _locked(function):
+    """Runs the method holding the lock of the process and the lock of the file"""
+    def wrapper(self, *args, **kwargs):
+        scratch = getattr(_scratch, "store", None)
+        if scratch is not None and scratch is not self:
+            return getattr(scratch, function.__name__)(*args, **kwargs)
+        with self._lock:
+            # the lock of the file is shared with forked children: they open it again
+            if self._pid != os.getpid():
+                self._open()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                return function(self, *args, **kwargs)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+
+class StateStore(metaclass=Singleton):
+    """
+    Key/value store shared by all the service processes and the worker
+    processes of the proxy, to keep state across connections without a
+    database round trip.
+
+    The data is a fixed size open addressing hash table in a memory mapped
+    file, so it survives restarts of the proxy. Values are integers, keys are
+    str or bytes. Every operation takes a thread lock and an flock on the file.
+    When the slots probed for a new key are all in use, the entry expiring
+    first is evicted: with the default capacity that only happens with
+    hundreds of thousands of live keys.
+
+        from src.state import StateStore
+
+        state = StateStore()
+        if state.incr(client_ip, ttl=60) > 100: ...
+        if state.seen_before(card_number): ...
+    """
+    def __init__(self, path: str = STATE_PATH, capacity: int = DEFAULT_CAPACITY):
+        self.path = path
+        self.default_capacity = capacity
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(fd).st_size < HEADER_SIZE:
+                os.ftruncate(fd, HEADER_SIZE + self.default_capacity * SLOT.size)
+                os.pwrite(fd, HEADER.pack(MAGIC, self.default_capacity), 0)
+            magic, capacity = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+            if magic != MAGIC:
+                raise ValueError(f"{self.path} is not a state file")
+            self._map = mmap.mmap(fd, HEADER_SIZE + capacity * SLOT.size)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        self._fd = fd
+        self.capacity = capacity
+        self._pid = os.getpid()
+
+    def _close(self):
+        if self._pid is not None:
+            self._map.close()
+            os.close(self._fd)
+            self._pid = None
+
+    def _find(self, digest: bytes, now: float):
+        """
+        Returns (offset of the slot of the key or None, offset of the slot
+        where the key can be inserted)
+        """
+        index = int.from_bytes(digest[:8], "little") % self.capacity
+        free = None
+        victim = None
+        victim_expiration = INFINITY
+        for _ in range(min(MAX_PROBES, self.capacity)):
+            offset = HEADER_SIZE + index * SLOT.size
+            status, key, expiration, _ = SLOT.unpack_from(self._map, offset)
+            if status == EMPTY:
+                return None, free if free is not None else offset
+            expired = expiration and expiration <= now
+            if status == USED and key == digest:
+                return (None, offset) if expired else (offset, offset)
+            if free is None:
+                if status == DELETED or expired:
+                    free = offset
+                elif victim is None or (expiration or INFINITY) < victim_expiration:
+                    victim, victim_expiration = offset, expiration or INFINITY
+            index += 1
+            if index == self.capacity:
+                index = 0
+        return None, free if free is not None else victim
+
+    def _write(self, offset: int, digest: bytes, value: int, ttl: float, now: float):
+        SLOT.pack_into(self._map, offset, USED, digest, now + ttl if ttl else 0.0, value)
+
+    def _get(self, digest: bytes, default):
+        now = time.time()
+        offset, _ = self._find(digest, now)
+        if offset is None:
+            return default
+        return SLOT.unpack_from(self._map, offset)[3]
+
+    def _set_if_absent(self, digest: bytes, ttl: float) -> bool:
+        now = time.time()
+        offset, free = self._find(digest, now)
+        if offset is not None:
+            return False
+        self._write(free, digest, 1, ttl, now)
+        return True
+
+    def _delete(self, digest: bytes) -> bool:
+        offset, _ = self._find(digest, time.time())
+        if offset is None:
+            return False
+        SLOT.pack_into(self._map, offset, DELETED, b"", 0.0, 0)
+        return True
+
+    @_locked
+    def get(self, key, default=None):
+        return self._get(_digest(b"key", key), default)
+
+    @_locked
+    def set(self, key, value: int = 1, ttl: float = None):
+        """ttl: seconds after which the key expires, None = never"""
+        digest = _digest(b"key", key)
+        now = time.time()
+        _, free = self._find(digest, now)
+        self._write(free, digest, value, ttl, now)
+
+    @_locked
+    def incr(self, key, amount: int = 1, ttl: float = None) -> int:
+        """Adds amount to the value of the key (0 if missing) and returns it. ttl only applies when the key is created"""
+        digest = _digest(b"key", key)
+        now = time.time()
+        offset, free = self._find(digest, now)
+        if offset is None:
+            self._write(free, digest, amount, ttl, now)
+            return amount
+        _, _, expiration, value = SLOT.unpack_from(self._map, offset)
+        SLOT.pack_into(self._map, offset, USED, digest, expiration, value + amount)
+        return value + amount
+
+    @_locked
+    def delete(self, key) -> bool:
+        return self._delete(_digest(b"key", key))
+
+    @_locked
+    def seen_before(self, key, ttl: float = None) -> bool:
+        """True if the key has already been seen, otherwise it is stored and False is returned"""
+        return not self._set_if_absent(_digest(b"key", key), ttl)
+
+    @_locked
+    def sadd(self, name, member, ttl: float = None) -> bool:
+        """Adds member to the set name, returns False if it was already there"""
+        return self._set_if_absent(_digest(b"set", name, member), ttl)
+
+    @_locked
+    def sismember(self, name, member) -> bool:
+        return self._get(_digest(b"set", name, member), None) is not None
+
+    @_locked
+    def srem(self, name, member) -> bool:
+        return self._delete(_digest(b"set", name, member))
+
+
+@contextmanager
+def scratch_state():
+    """
+    Redirects the StateStore operations of the current thread to an empty
+    temporary store, so the dry run of the filters doesn't change the state
+    seen by the connections
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        # bypasses the singleton
+        store = type.__call__(StateStore, os.path.join(directory, "state.db"), SCRATCH_CAPACITY)
+        _scratch.store = store
+        try:
+            yield store
+        finally:
+            _scratch.store = None
+            store._close()
@@ -1,5 +1,7 @@
-from src.http_parsing import HttpMessageParser, HttpMessage
+from src.http_parsing import HttpMessage, LazyHttpMessage, LazyHttpMessages, MAX_DECOMPRESSED_SIZE, MAX_DECOMPRESSION_RATIO
+from src.features import MessageFeatures
 from collections import deque
+import copy
 
 # class NoIndexError(deque):
 #     def __getitem__(self, key):
@@ -13,10 +15,34 @@ class Stream():
         self.current_message = b""
         self.previous_messages = deque(maxlen=max_stored_messages)
         self._max_message_size = max_message_size
+        self._features = None
+
+    @property
+    def features(self) -> MessageFeatures:
+        """Features of current_message, computed on first access and shared by all the filters"""
+        # filters may replace current_message: its features are computed again
+        if self._features is None or self._features.message is not self.current_message:
+            self._features = MessageFeatures(self)
+        return self._features
 
     def set_current_message(self, data: bytes):
         pass
 
+    def restore(self, current_message: bytes, previous_messages):
+        """Rebuilds the stream from a snapshot of its messages (previous_messages newest to oldest)"""
+        self.previous_messages.extend(previous_messages)
+        self.current_message = current_message
+
+    def copy(self):
+        """Shallow copy with its own history, for filters the relay may stop waiting for"""
+        clone = copy.copy(self)
+        clone.previous_messages = self.previous_messages.copy()
+        return clone
+
+    def adopt(self, clone):
+        """Takes back the state of a copy whose filters have completed"""
+        self.__dict__.update(clone.__dict__)
+
 class TCPStream(Stream):
     """
     Class for storing TCP data of a single connection.
@@ -24,6 +50,8 @@ class TCPStream(Stream):
     current_message: current message as bytes received (this will be sent to the socket, it can be modified)
 
     previous_messages: latest max_stored_messages messages of the connection before current_message (newest to oldest)
+
+    features: data derived from current_message (lowercase message, entropy, ...), see MessageFeatures
     """
     def set_current_message(self, data: bytes):
         if len(self.current_message) <= self._max_message_size:
@@ -31,6 +59,7 @@ class TCPStream(Stream):
         else:
             self.previous_messages.appendleft(self.current_message[-self._max_message_size])
         self.current_message = data
+        self._features = None
 class HTTPStream(Stream):
     """
     Class for storing HTTP data of a single connection.
@@ -42,23 +71,47 @@ class HTTPStream(Stream):
     current_http_message: current_message parsed as HttpMessage
 
     previous_http_messages: previous_messages parsed as HttpMessage (newest to oldest)
+
+    max_decompressed_size, max_decompression_ratio: limits of the decompressed bodies, see HttpMessage
+
+    features: data derived from current_message (lowercase message, decoded path and parameters, ...), see MessageFeatures
     """
-    def __init__(self, max_stored_messages: int = 50, max_message_size: int = 65535):
+    def __init__(self, max_stored_messages: int = 50, max_message_size: int = 65535,
+                 max_decompressed_size: int = MAX_DECOMPRESSED_SIZE, max_decompression_ratio: float = MAX_DECOMPRESSION_RATIO):
         super().__init__(max_stored_messages, max_message_size)
-        self.current_http_message = None
-        self.previous_http_messages: deque[HttpMessage] = deque(maxlen=max_stored_messages)
+        self.decompression_limits = (max_decompressed_size, max_decompression_ratio)
+        # messages are parsed on first access and the parsed object of the
+        # current message is reused when it moves into the history
+        self._current_http_message = LazyHttpMessage(self.current_message, self.decompression_limits)
+        self.previous_http_messages: deque[HttpMessage] = LazyHttpMessages(maxlen=max_stored_messages)
+
+    def restore(self, current_message: bytes, previous_messages):
+        super().restore(current_message, previous_messages)
+        self.previous_http_messages.extend(LazyHttpMessage(message, self.decompression_limits) for message in self.previous_messages)
+        self._current_http_message = LazyHttpMessage(current_message, self.decompression_limits)
+
+    def copy(self):
+        clone = super().copy()
+        # deque.copy would iterate the parsed messages
+        clone.previous_http_messages = LazyHttpMessages(deque.__iter__(self.previous_http_messages), maxlen=self.previous_http_messages.maxlen)
+        return clone
+
+    @property
+    def current_http_message(self) -> HttpMessage:
+        return self._current_http_message.message
 
     def set_current_message(self, data: bytes):
         if len(self.current_message) <= self._max_message_size:
             self.previous_messages.appendleft(self.current_message)            
         else:
             self.previous_messages.appendleft(self.current_message[:self._max_message_size])
-        
+
+        # filters may have replaced current_message after it was parsed, and
+        # the history holds truncated messages
+        if self._current_http_message.raw is not self.current_message or len(self.current_message) > self._max_message_size:
+            self._current_http_message = LazyHttpMessage(self.previous_messages[0], self.decompression_limits)
+        self.previous_http_messages.appendleft(self._current_http_message)
+
         self.current_message = data
-        
-        try:            
-            self.previous_http_messages.appendleft(HttpMessageParser(self.previous_messages[0]).to_message())
-            self.current_http_message = HttpMessageParser(data).to_message()
-        except Exception as e:
-            self.current_http_message = None
-            print("Error in HTTP parsing:", str(e))
\ No newline at end of file
+        self._current_http_message = LazyHttpMessage(data, self.decompression_limits)
+        self._features = None
@@ -19,69 +19,18 @@ def vprint(msg, is_verbose):
     if is_verbose:
         print(msg)
 
-def receive_from(s: socket.socket, http, verbose=False):
-    """Receive data from a socket until no more data is there"""
-    b = b""
-    if not http:
-        while True:
-            data = s.recv(4096)
-            b += data
-            if not data or len(data) < 4096:
-                break
-    else:
-        with s.makefile(mode = "rb", buffering=True) as fp:
-            b += fp.readline()
-            if len(b) == 0:
-                return b
-            
-            # read headers
-            content_len = 0
-            chunked = False
-            len_headers = 0
-            while True:
-                line = fp.readline(65537)
-                len_headers += 1
-                if len(line) > 65536:
-                    vprint("Header line too long.", verbose)
-                    return b""
-                if len_headers > 100:
-                    vprint("Too many headers", verbose)
-                    return b""
-                b += line
-                if line in (b'\r\n', b'\n', b''):
-                    break
-                line = line.decode().lower()
-                if "content-length" in line:
-                    content_len = int(line.split(":")[1])
-                elif "transfer-encoding" in line:
-                    chunked = "chunked" in line
-
-            if content_len:
-                content_len = int(content_len)
-                b += fp.read(content_len)
-            elif chunked:
-                while True:
-                    line = fp.readline()
-                    b+= line
-                    line = line.strip()
-                    chunk_length = int(line, 16)
-
-                    if chunk_length != 0:
-                        chunk = fp.read(chunk_length)
-                        b += chunk
-                    # Each chunk is followed by an additional empty newline
-                    # that we have to consume.
-                    b += fp.readline()
-
-                    # Finally, a chunk size of 0 is an end indication
-                    if chunk_length == 0:
-                        break
-    return b
-
-def filter_packet(data, filter_module):
-    if filter_module is not None:
+def get_address_family(host):
+    try:
+        result = socket.getaddrinfo(host, 0, socket.AF_UNSPEC, socket.SOCK_STREAM)
+        return result[0][0]
+    except socket.gaierror as e:
+        print(f"Error resolving host: {e}")
+        return None
+
+def filter_packet(data, filter_chain, progress=None):
+    if filter_chain is not None:
         try:
-            attack = filter_module.execute(data)
+            attack = filter_chain.execute(data, progress)
             if attack is not None:
                 return attack
         except:
@@ -96,7 +45,7 @@ def block_packet(local_socket: socket.socket, socket_family, remote_socket, bloc
             local_socket.detach(), socket_family, socket.SOCK_STREAM)
 
     local_socket.send(block_answer.encode())
-    if dos.get("enabled"):
+    if dos and dos.get("enabled"):
         start = time.time()
         try:
             while time.time() - start < dos["duration"]:
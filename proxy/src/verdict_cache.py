@@ -0,0 +1,46 @@
+import threading
+from collections import OrderedDict
+
+# rewritten messages bigger than this are not cached, so an entry takes at most a few KB
+MAX_CACHED_REWRITE = 4096
+
+
+class VerdictCache():
+    """
+    LRU cache of the results of the stateless filters of a chain.
+
+    Keys are (step, hash(message), len(message)): the hash of a bytes object is
+    computed once and cached by Python, and it is keyed per process, so
+    attackers can't craft collisions. Values are (attack, rewritten message or
+    None). The cache belongs to a FilterChain, so it is dropped with it when the
+    module is reloaded.
+    """
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, attack, rewritten: bytes = None):
+        if rewritten is not None and len(rewritten) > MAX_CACHED_REWRITE:
+            return
+        with self._lock:
+            self.entries[key] = (attack, rewritten)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
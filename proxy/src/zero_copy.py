@@ -0,0 +1,36 @@
+import os
+import fcntl
+
+# amount of data moved by a single splice call
+PIPE_SIZE = 1 << 16
+
+# splice is only available on Linux (Python >= 3.10)
+SPLICE_SUPPORTED = hasattr(os, "splice")
+
+
+class SplicePipe():
+    """
+    Kernel pipe used to move data between two sockets without copying it
+    into the Python process: socket -> pipe -> socket.
+    """
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        try:
+            fcntl.fcntl(self.write_fd, fcntl.F_SETPIPE_SZ, PIPE_SIZE)
+        except (AttributeError, OSError):
+            pass
+
+    def transfer(self, source, destination) -> int:
+        """
+        Moves the data available on the source socket to the destination one.
+        Returns the number of bytes moved, 0 if source has been closed.
+        """
+        received = os.splice(source.fileno(), self.write_fd, PIPE_SIZE, flags=os.SPLICE_F_MOVE)
+        sent = 0
+        while sent < received:
+            sent += os.splice(self.read_fd, destination.fileno(), received - sent, flags=os.SPLICE_F_MOVE)
+        return received
+
+    def close(self):
+        os.close(self.read_fd)
+        os.close(self.write_fd)
@@ -0,0 +1,105 @@
+"""
+Measure the round trip of the FilterBroker tasks.
+
+A broker is started with a filter and a subscribed service, then clients ask
+for the filter names (transport only) and for the subscribed filters, as
+service processes do, from threads of the broker process and from other
+processes, waiting for each reply or pipelining the asks with submit and
+result. The cost of Manager().Queue(), which
+the previous transport paid for every task, is printed for comparison.
+Run it from the backend folder:
+
+    python3 benchmark.py --clients 4 --asks 2000
+"""
+import argparse
+import threading
+import time
+from multiprocessing import Manager, Process, SimpleQueue
+from proxy.multiprocess.FilterBroker import FilterBroker
+from proxy.multiprocess.FilterBrokerAsker import FilterBrokerAsker
+from proxy.multiprocess.Filter import Filter
+from proxy.service import Service
+
+SERVICE = Service(name="benchmark", port=2222, type="tcp", active=True)
+
+
+def filter_function(service, stream):
+    return False
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def client(asker, task, asks, results):
+    latencies = []
+    for _ in range(asks):
+        start = time.perf_counter()
+        asker.ask(*task)
+        latencies.append(time.perf_counter() - start)
+    results.put(latencies)
+
+
+def pipelined_client(asker, task, asks, results):
+    # The latency of an ask includes the time spent queued behind the others
+    start = time.perf_counter()
+    request_ids = [asker.submit(*task) for _ in range(asks)]
+    latencies = []
+    for request_id in request_ids:
+        asker.result(request_id)
+        latencies.append(time.perf_counter() - start)
+    results.put(latencies)
+
+
+def benchmark(name, asker, task, clients, asks, in_process, target=client):
+    results = SimpleQueue()
+    if in_process:
+        workers = [threading.Thread(target=target, args=(asker, task, asks, results)) for _ in range(clients)]
+    else:
+        workers = [Process(target=target, args=(asker, task, asks, results)) for _ in range(clients)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    latencies = sorted(latency for _ in workers for latency in results.get())
+    elapsed = time.perf_counter() - start
+    for worker in workers:
+        worker.join()
+
+    print(f"{name:>32}: {len(latencies) / elapsed:10.0f} asks/s  "
+          f"p50 {percentile(latencies, 0.50) * 1e6:8.1f} us  "
+          f"p99 {percentile(latencies, 0.99) * 1e6:8.1f} us  "
+          f"max {latencies[-1] * 1e6:8.1f} us")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the FilterBroker round trip")
+    parser.add_argument("--clients", type=int, default=4, help="concurrent asking threads or processes")
+    parser.add_argument("--asks", type=int, default=2000, help="asks of each client")
+    args = parser.parse_args()
+
+    broker = FilterBroker(SimpleQueue())
+    asker = FilterBrokerAsker(broker.queue, broker.generation)
+    broker.start()
+    asker.ask(FilterBroker.add_filter, "benchmark", Filter(filter_function))
+    asker.ask(FilterBroker.subscribe_service, SERVICE, "benchmark")
+
+    print(f"{args.clients} clients x {args.asks} asks")
+    for task in [(FilterBroker.list_filters,), (FilterBroker.get_subscribed_filters, SERVICE)]:
+        for in_process in [True, False]:
+            name = f"{task[0].__name__} ({'threads' if in_process else 'processes'})"
+            benchmark(name, asker, task, args.clients, args.asks, in_process)
+        benchmark(f"{task[0].__name__} (pipelined)", asker, task, args.clients, args.asks, False, pipelined_client)
+
+    start = time.perf_counter()
+    for _ in range(20):
+        Manager().Queue()
+    print(f"{'Manager().Queue()':>32}: {(time.perf_counter() - start) / 20 * 1e6:8.1f} us")
+
+    broker.queue.put(None)
+    broker.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,13 @@
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field
 from typing import Optional
 import logging
 
 # Local imports
 from ..service import Service, NGINXConfigurationManager
-from ..multiprocess import service_manager, namespace
+from ..multiprocess import service_manager, namespace, broker, asker, FilterBroker
 from ..configuration.constants import TITLE, DESCRIPTION, VERSION
 from ..configuration.proxyConfigurationManager import ProxyConfigurationManager
 from ..utils import authenticate_request
@@ -20,16 +21,38 @@ async def lifespan(app: FastAPI):
     It initializes data on startup and cleans up on shutdown."""
     try:
         settings = ProxyConfigurationManager.load_configuration()
+        # The service processes get their filters from the broker
+        broker.start()
         # TODO: Load the configuration from a JSON file
         yield
         # TODO: Save the configuration to a JSON file
     except Exception as e:
         logging.error(f"Error during lifespan management: {e}")
+    finally:
+        if broker.is_alive():
+            broker.queue.put(None)
 
 
 app = FastAPI(lifespan=lifespan, title=TITLE, description=DESCRIPTION, version=VERSION)
 
 
+class FilterOperation(BaseModel):
+    """
+    An operation of a filter batch.
+
+    Attributes:
+        operation (str): 'subscribe', 'unsubscribe', 'unsubscribe_all' or 'remove_filter'.
+        service_name (str, optional): The service of the (un)subscription.
+        filter_name (str, optional): The filter to (un)subscribe or remove.
+        priority (int): The priority of a subscription, see FilterBroker.subscribe_service.
+    """
+
+    operation: str = Field(..., pattern="^(subscribe|unsubscribe|unsubscribe_all|remove_filter)$")
+    service_name: Optional[str] = None
+    filter_name: Optional[str] = None
+    priority: int = 0
+
+
 @app.put("/service")
 async def put_service(service: Service, request: Request, ssl_cert: Optional[str] = None):
     """
@@ -223,3 +246,49 @@ async def patch_service(request: Request, service_name : str, service: Service,
 
     return JSONResponse(status_code=200, content={"message": "Service updated successfully"})
 
+
+@app.post("/filters/batch")
+async def post_filters_batch(request: Request, operations: list[FilterOperation]):
+    """
+    Applies several filter operations atomically: the service processes see
+    either all of them or none of them.
+    Args:
+        request (Request): The HTTP request object, used for authentication.
+        operations (list[FilterOperation]): The operations, applied in order.
+    Raises:
+        HTTPException: If a service does not exist or an operation misses its arguments.
+        HTTPException: If an operation fails, in which case no operation is applied.
+    Returns:
+        JSONResponse: A response indicating the successful application of the operations.
+    """
+
+    authenticate_request(request)
+
+    tasks = []
+    with namespace.service_lock:
+        for operation in operations:
+            if operation.operation != "remove_filter" and not operation.service_name:
+                raise HTTPException(status_code=400, detail=f"Service name is required for {operation.operation}")
+            if operation.operation != "unsubscribe_all" and not operation.filter_name:
+                raise HTTPException(status_code=400, detail=f"Filter name is required for {operation.operation}")
+
+            if operation.service_name:
+                service_json = ProxyConfigurationManager.get_service_information(operation.service_name)
+                if not service_json:
+                    raise HTTPException(status_code=404, detail=f"Service '{operation.service_name}' not found")
+                service = Service(name=operation.service_name, port=service_json["port"], type=service_json["type"], active=service_json["active"])
+
+            if operation.operation == "subscribe":
+                tasks.append((FilterBroker.subscribe_service, service, operation.filter_name, None, operation.priority))
+            elif operation.operation == "unsubscribe":
+                tasks.append((FilterBroker.unsubscribe_service, service, operation.filter_name))
+            elif operation.operation == "unsubscribe_all":
+                tasks.append((FilterBroker.unsubscribe_all, service))
+            else:
+                tasks.append((FilterBroker.remove_filter, operation.filter_name))
+
+    # One broker turn for the whole batch
+    if asker.ask_batch(tasks) is None:
+        raise HTTPException(status_code=400, detail="An operation failed, no operation was applied")
+
+    return JSONResponse(status_code=200, content={"message": f"{len(tasks)} filter operations applied successfully"})
@@ -1,4 +1,5 @@
 from ..service import Service
+from .FilterCode import codes
 
 class Filter:
     """
@@ -13,15 +14,20 @@ class Filter:
         filterFunction (callable): A function that takes a Stream object as input 
                                    and returns a boolean indicating whether the 
                                    stream matches the filter condition.
-        subscribers (list[Service]): A list of Service instances that are 
-                                     subscribed to this filter.
+        subscribers (dict[Service, None]): The Service instances that are
+                                           subscribed to this filter, in
+                                           subscription order (a dict is used
+                                           as an ordered set).
+        digest (str): The content digest of the filter function, used to send
+                      the function by reference once a process has received it
+                      (see FilterCode).
 
     Methods:
         - add_subscriber(service: Service) -> None:
             Subscribes a service to this filter.
 
         - remove_subscriber(service: Service) -> None:
-            Unsubscribes a service from this filter.
+            Unsubscribes a service from this filter, if it is subscribed.
 
         - is_subscriber(service: Service) -> bool:
             Checks if a service is currently subscribed.
@@ -40,34 +46,44 @@ class Filter:
 
     def __init__(self, filter_function : callable) -> None:
         """
-        Initializes a filter with a filter function and an empty list of subscribers.
+        Initializes a filter with a filter function and no subscribers.
 
         Args:
             filterFunction (callable): a function that takes a Stream object and returns a boolean
         """
 
-        self.filter_function : str = filter_function
-        self.subscribers : list[Service] = []
+        self.filter_function, self.digest = codes.register(filter_function)
+        self.subscribers : dict[Service, None] = {}
+
+
+    def __setstate__(self, state : dict) -> None:
+        """
+        Restores a deserialized filter, sharing the function with the other
+        filters of the process that have the same code.
+        """
+        self.__dict__.update(state)
+        self.filter_function, _ = codes.register(self.filter_function, self.digest)
 
     
     def add_subscriber(self, service : Service) -> None:
         """
-        Adds a service to the list of subscribers of the filter.
+        Adds a service to the subscribers of the filter.
 
         Args:
-            service (Service): the service to add to the list of subscribers
+            service (Service): the service to add to the subscribers
         """
-        self.subscribers.append(service)
+        self.subscribers[service] = None
 
     
     def remove_subscriber(self, service : Service) -> None:
         """
-        Removes a service from the list of subscribers of the filter.
+        Removes a service from the subscribers of the filter. Nothing happens
+        if the service is not subscribed.
 
         Args:
-            service (Service): the service to remove from the list of subscribers
+            service (Service): the service to remove from the subscribers
         """
-        self.subscribers.remove(service)
+        self.subscribers.pop(service, None)
 
 
     def is_subscriber(self, service : Service) -> bool:
@@ -104,7 +120,7 @@ class Filter:
         Returns:
             list[Service]: A copy of the list of subscribers.
         """
-        return self.subscribers.copy()
+        return list(self.subscribers)
 
 
     def clear_subscribers(self) -> None:
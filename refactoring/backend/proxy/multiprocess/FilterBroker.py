@@ -1,11 +1,15 @@
 import inspect
+from itertools import count
 import logging
 import dill
 from .Filter import Filter
+from .FilterBrokerAsker import FilterBrokerAsker, REGISTER, UNKNOWN_CODE
+from .FilterSnapshot import FilterSnapshot
+from . import FilterCode
 from ..service import Service
 
 from threading import Thread
-from multiprocessing import Queue, Manager
+from multiprocessing import SimpleQueue, Value
 
 class FilterBroker(Thread):
     """
@@ -18,6 +22,11 @@ class FilterBroker(Thread):
 
     Attributes:
         filters (dict[str, Filter]): A dictionary storing filters by their names.
+        subscriptions (dict[Service, dict[str, tuple[int, int]]]): For each service, the names
+            of the subscribed filters with their (priority, subscription number) sort key.
+            Together with Filter.subscribers it indexes subscriptions in both directions.
+        generation (Value): Shared counter increased whenever filters or subscriptions
+            change, so service processes know when their FilterSnapshot is outdated.
 
     Methods:
         - __init__(): Initializes an empty filter broker.
@@ -26,7 +35,9 @@ class FilterBroker(Thread):
         - get_filter(name: str): Retrieves a filter by its name.
         - get_subscribed_filters(service: Service): Returns a list of filters the 
             given service is subscribed to.
-        - subscribe_service(service: Service, filter_name: str = None, filter: Filter = None): 
+        - get_subscribed_filter_names(service: Service): Returns the names of the filters
+            the given service is subscribed to, in evaluation order.
+        - subscribe_service(service: Service, filter_name: str = None, filter: Filter = None, priority: int = 0): 
             Subscribes a service to a filter.
         - unsubscribe_service(service: Service, filter_name: str = None, filter: Filter = None): 
             Unsubscribes a service from a filter.
@@ -39,18 +50,79 @@ class FilterBroker(Thread):
         - get_all_subscribed_services(): Retrieves all unique services subscribed to any filter.
         - clear_all_filters(): Clears all filters from the broker and unsubscribes all services.
         - filter_exists(name: str): Checks if a filter with the specified name exists in the broker.
+        - get_snapshot(service: Service): Returns the current FilterSnapshot of a service.
+        - batch(operations: list[tuple]): Executes several operations atomically.
     """
 
 
-    def __init__(self, queue : Queue) -> None:
+    def __init__(self, queue : SimpleQueue) -> None:
         super().__init__()
         self.queue = queue
         self.filters: dict[str, Filter] = {}
+        self.subscriptions: dict[Service, dict[str, tuple[int, int]]] = {}
+        self._subscription_numbers = count()
+        # Reply pipes of the asking processes, by client id
+        self.clients: dict[str, object] = {}
+        # Digests of the filter functions already sent to each client
+        self.sent_codes: dict[str, set[str]] = {}
+        self.asker : FilterBrokerAsker = None
+        # Only the broker writes it: readers don't need a lock
+        self.generation = Value("Q", 0, lock=False)
+        self.snapshots: dict[Service, FilterSnapshot] = {}
+
+
+    def _publish(self):
+        """
+        Marks the published snapshots as outdated.
+        """
+        self.snapshots.clear()
+        self.generation.value += 1
+
+
+    def _name_of(self, filter: Filter) -> str:
+        """
+        Returns the name of a filter object of the broker.
+
+        Raises:
+            KeyError: If the filter is not in the broker.
+        """
+        for name, candidate in self.filters.items():
+            if candidate is filter:
+                return name
+        raise KeyError("Filter not found.")
+
+
+    def _release_code(self, filter: Filter):
+        """
+        Drops the function of a filter leaving the broker from the code cache,
+        unless another filter uses the same code.
+        """
+        if all(other.digest != filter.digest for other in self.filters.values()):
+            FilterCode.codes.evict(filter.digest)
+
+
+    def _subscribe(self, service: Service, name: str, priority: int):
+        self.filters[name].add_subscriber(service)
+        filters = self.subscriptions.setdefault(service, {})
+        if name not in filters:
+            filters[name] = (priority, next(self._subscription_numbers))
+        else:
+            filters[name] = (priority, filters[name][1])
+
+
+    def _unsubscribe(self, service: Service, name: str):
+        self.filters[name].remove_subscriber(service)
+        filters = self.subscriptions.get(service)
+        if filters is not None:
+            filters.pop(name, None)
+            if not filters:
+                del self.subscriptions[service]
 
 
     def add_filter(self, name: str, filter: Filter):
         """
-        Adds a filter to the filter broker.
+        Adds a filter to the filter broker. A filter replacing another one with
+        the same name keeps its subscriptions, with their priorities.
 
         Args:
             name (str): The name of the filter.
@@ -64,7 +136,18 @@ class FilterBroker(Thread):
             raise TypeError("Invalid Filter: must have exactly two parameters")
         
         # Add the filter to the dictionary of filters
+        previous = self.filters.get(name)
         self.filters[name] = filter
+        if previous is not None:
+            # The subscriptions of the name stay in the index
+            for service in previous.get_subscribers():
+                filter.add_subscriber(service)
+            self._release_code(previous)
+        # Index the services the new filter comes subscribed by
+        for service in filter.get_subscribers():
+            if name not in self.subscriptions.get(service, {}):
+                self._subscribe(service, name, 0)
+        self._publish()
 
 
     def remove_filter(self, name: str):
@@ -78,7 +161,10 @@ class FilterBroker(Thread):
             KeyError: If the filter with the given name does not exist.
         """
         if name in self.filters:
-            del self.filters[name]
+            for service in self.filters[name].get_subscribers():
+                self._unsubscribe(service, name)
+            self._release_code(self.filters.pop(name))
+            self._publish()
         else:
             raise KeyError(f"Filter '{name}' not found.")
     
@@ -102,9 +188,25 @@ class FilterBroker(Thread):
             raise KeyError(f"Filter '{name}' not found.")
     
 
+    def get_subscribed_filter_names(self, service: Service):
+        """
+        Returns the names of the filters that the given service is subscribed to,
+        in evaluation order: by priority, then by subscription order.
+
+        Args:
+            service (Service): The service to check for subscriptions.
+
+        Returns:
+            list[str]: The names of the filters that the given service is subscribed to.
+        """
+        filters = self.subscriptions.get(service, {})
+        return sorted(filters, key=filters.__getitem__)
+
+
     def get_subscribed_filters(self, service: Service):
         """
-        Returns a list of filters that the given service is subscribed to.
+        Returns a list of filters that the given service is subscribed to, in
+        evaluation order (see get_subscribed_filter_names).
 
         Args:
             service (Service): The service to check for subscriptions.
@@ -112,27 +214,31 @@ class FilterBroker(Thread):
         Returns:
             list[Filter]: A list of filters that the given service is subscribed to.
         """
-        return [filter for filter in self.filters.values() if filter.is_subscriber(service)]
+        return [self.filters[name] for name in self.get_subscribed_filter_names(service)]
     
 
-    def subscribe_service(self, service: Service, filter_name: str = None, filter: Filter = None):
+    def subscribe_service(self, service: Service, filter_name: str = None, filter: Filter = None, priority: int = 0):
         """
-        Subscribes a service to a specified filter.
+        Subscribes a service to a specified filter. Subscribing again only updates the priority.
 
         Args:
             service (Service): The service to subscribe.
             filter_name (str, optional): The name of the filter to subscribe to. Defaults to None.
             filter (Filter, optional): The filter object to subscribe to. Defaults to None.
+            priority (int, optional): Filters with lower priority are evaluated first,
+                filters with the same priority in subscription order. Defaults to 0.
 
         Raises:
             TypeError: If neither filter_name nor filter instance is provided.
+            KeyError: If the filter is not in the broker.
         """
         if filter_name:
-            self.filters[filter_name].add_subscriber(service)
+            self._subscribe(service, filter_name, priority)
         elif filter:
-            filter.add_subscriber(service)
+            self._subscribe(service, self._name_of(filter), priority)
         else:
             raise TypeError("Filter name or filter instance must be provided")
+        self._publish()
     
     
     def unsubscribe_service(self, service: Service, filter_name: str = None, filter: Filter = None):
@@ -146,21 +252,24 @@ class FilterBroker(Thread):
 
         Raises:
             TypeError: If neither filter_name nor filter instance is provided.
+            KeyError: If the filter is not in the broker.
         """
         if filter_name:
-            self.filters[filter_name].remove_subscriber(service)
+            self._unsubscribe(service, filter_name)
         elif filter:
-            filter.remove_subscriber(service)
+            self._unsubscribe(service, self._name_of(filter))
         else:
             raise TypeError("Filter name or filter instance must be provided")
+        self._publish()
     
     
     def unsubscribe_all(self, service: Service):
         """
         Unsubscribes the given service from all filters.
         """
-        for filter in self.filters.values():
-            filter.remove_subscriber(service)
+        for name in self.subscriptions.pop(service, {}):
+            self.filters[name].remove_subscriber(service)
+        self._publish()
 
     
     def list_filters(self):
@@ -207,9 +316,7 @@ class FilterBroker(Thread):
             KeyError: If the filter with the given name does not exist.
         """
         
-        if filter_name in self.filters:
-            return self.filters[filter_name].is_subscriber(service)
-        return False
+        return filter_name in self.subscriptions.get(service, {})
 
 
     def get_all_subscribed_services(self):
@@ -219,10 +326,7 @@ class FilterBroker(Thread):
         Returns:
             list[Service]: A list of unique services that are subscribed to at least one filter.
         """
-        services = set()
-        for filter in self.filters.values():
-            services.update(filter.subscribers)
-        return list(services)
+        return list(self.subscriptions)
     
     
     def clear_all_filters(self):
@@ -231,7 +335,11 @@ class FilterBroker(Thread):
         
         This method is used when resetting the proxy to its initial state.
         """
+        for filter in self.filters.values():
+            FilterCode.codes.evict(filter.digest)
         self.filters.clear()
+        self.subscriptions.clear()
+        self._publish()
 
 
     def filter_exists(self, name: str):
@@ -246,6 +354,56 @@ class FilterBroker(Thread):
         """
         return name in self.filters
     
+    def get_snapshot(self, service: Service) -> FilterSnapshot:
+        """
+        Returns the filters the given service is subscribed to as an immutable snapshot,
+        tagged with the current generation.
+
+        Args:
+            service (Service): The service to get the filters of.
+
+        Returns:
+            FilterSnapshot: The snapshot of the subscribed filters.
+        """
+        snapshot = self.snapshots.get(service)
+        if snapshot is None:
+            filters = tuple((name, self.filters[name]) for name in self.get_subscribed_filter_names(service))
+            snapshot = self.snapshots[service] = FilterSnapshot(self.generation.value, service, filters)
+        return snapshot
+
+
+    def batch(self, operations: list[tuple]):
+        """
+        Executes several operations in a single broker turn: either all of them
+        are applied or, if one raises an exception, none of them.
+
+        Args:
+            operations (list[tuple]): The FilterBroker methods to call, each
+                followed by its arguments, like the tasks of FilterBrokerAsker.ask.
+
+        Returns:
+            list: The results of the operations.
+
+        Raises:
+            Exception: The exception of the failed operation, after the rollback.
+        """
+        filters = dict(self.filters)
+        subscriptions = {service: dict(names) for service, names in self.subscriptions.items()}
+        subscribers = [(filter, dict(filter.subscribers)) for filter in filters.values()]
+        try:
+            return [method(self, *args) for method, *args in operations]
+        except Exception as e:
+            self.filters = filters
+            self.subscriptions = subscriptions
+            for filter, filter_subscribers in subscribers:
+                filter.subscribers = filter_subscribers
+                # Its code may have been evicted
+                FilterCode.codes.register(filter.filter_function, filter.digest)
+            self._publish()
+            logging.error(f"[{self.__class__.__name__}]: Batch rolled back: {e}")
+            raise
+
+
     def print(*args):
         """
         Prints the provided arguments to the console.
@@ -260,10 +418,13 @@ class FilterBroker(Thread):
         """
         Executes tasks from the queue in a loop until a termination signal is received.
         This method continuously retrieves tasks from the queue and processes them.
-        Each task is expected to be a tuple containing a callable method, a response
-        queue, and optional arguments. The callable method is executed with the
-        current instance (`self`) and the provided arguments, and its result is
-        placed into the response queue.
+        A task is a tuple containing the id of the asking client, a request id,
+        the pickled callable method and its pickled arguments, where the filter
+        functions the broker already has are replaced by their digest (see
+        FilterCode). The callable method
+        is executed with the current instance (`self`) and the provided arguments,
+        and its result is sent with the request id through the reply pipe of the
+        client, registered by a (REGISTER, client id, pipe) message.
         The loop terminates when a `None` task is retrieved from the queue.
         Exceptions during task execution are caught and can be handled (e.g., logged).
         Raises:
@@ -272,34 +433,49 @@ class FilterBroker(Thread):
         class_name = self.__class__.__name__
         logging.info(f"[{class_name}]: Process started")
         while True:
+            task = self.queue.get()
+            if task is None:
+                break
+
+            if task[0] == REGISTER:
+                _, client_id, reply_pipe = task
+                self.clients[client_id] = reply_pipe
+                self.sent_codes[client_id] = set()
+                continue
+
+            client_id, request_id, pickled_method, pickled_args = task
             try:
-                task = self.queue.get()
-                if task is None:
-                    break
-                
-                response_queue, pickled_task = task
-                method, *args = dill.loads(pickled_task)
+                method = dill.loads(pickled_method)
+                args = FilterCode.loads(pickled_args)
                 response = method(self, *args)
 
                 if response:
-                    response = dill.dumps(response)
+                    response = FilterCode.dumps(response, self.sent_codes.setdefault(client_id, set()))
+
+            except FilterCode.UnknownCode as e:
+                # The code was evicted with its filter: the client sends it again by value
+                response = (UNKNOWN_CODE, e.digest)
 
             except Exception as e:
                 response = None
-            finally:
-                if task is not None:
-                    response_queue.put_nowait(response)
 
+            try:
+                self.clients[client_id].send((request_id, response))
+            except (KeyError, OSError):
+                # The asking process is gone
+                self.clients.pop(client_id, None)
+                self.sent_codes.pop(client_id, None)
 
 
     @staticmethod
     def ask(fb : 'FilterBroker', *task):
-        response_queue = Manager().Queue()
-        fb.queue.put((response_queue, *task))
-        print("I put in queue")
-        result = response_queue.get()
-        print("I got result")
-        return result
-        
+        """
+        Sends a task to the broker from any thread or process and waits for its result.
 
-        
+        Args:
+            fb (FilterBroker): The broker executing the task.
+            *task: The FilterBroker method to call followed by its arguments.
+        """
+        if fb.asker is None:
+            fb.asker = FilterBrokerAsker(fb.queue, fb.generation)
+        return fb.asker.ask(*task)
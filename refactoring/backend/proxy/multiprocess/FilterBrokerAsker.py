@@ -1,16 +1,181 @@
-from multiprocessing import Manager, Queue
+from multiprocessing import Pipe, SimpleQueue, Value
+from itertools import count
+import threading
+import uuid
+import os
+import pickle
 import dill
+from . import FilterCode
+
+# First item of the message registering the reply channel of a process
+REGISTER = "register"
+
+# First item of the reply to a task sending by digest a function the broker doesn't have anymore
+UNKNOWN_CODE = "unknown_code"
+
+# Serializes the creation of the reply channel among the threads of a process
+_connect_lock = threading.Lock()
+
+
+def dump_method(method: callable) -> bytes:
+    """
+    Pickles the method of a task. FilterBroker methods are pickled by reference,
+    dill would serialize their code and globals (tens of KB) on every task.
+    """
+    try:
+        return pickle.dumps(method)
+    except (pickle.PicklingError, AttributeError):
+        return dill.dumps(method)
+
 
 class FilterBrokerAsker:
+    """
+    Sends tasks to a FilterBroker and waits for their results.
+
+    Tasks go through the queue of the broker, results come back through a
+    pipe owned by the asking process: the pipe is created and registered to
+    the broker on the first ask of each process, then reused by all its
+    threads. Every task carries a request id, so a reply reaches the thread
+    waiting for it. A reader thread of the process empties the pipe as soon
+    as the replies arrive, so the broker never blocks sending a reply, and
+    stalls the other processes, however many replies the process has not
+    collected yet.
+
+    Attributes:
+        queue (SimpleQueue): The task queue of the FilterBroker.
+        generation (Value): The generation counter of the FilterBroker, see FilterSnapshot.
+    """
 
-    def __init__(self, queue: Queue) -> None:
+    def __init__(self, queue: SimpleQueue, generation: Value = None) -> None:
         self.queue = queue
+        self.generation = generation
+        self._pid = None
 
-    def ask(self, *task):
-        pickled_task = dill.dumps(task)
-        response_queue = Manager().Queue()
-        self.queue.put((response_queue, pickled_task))
-        result = response_queue.get()
+
+    def __getstate__(self):
+        # The reply channel belongs to the process that created it
+        return {"queue": self.queue, "generation": self.generation}
+
+
+    def __setstate__(self, state):
+        self.__init__(state["queue"], state["generation"])
+
+
+    def _connect(self) -> None:
+        """
+        Creates the reply channel of the current process and registers it to the broker.
+        """
+        self._condition = threading.Condition()
+        # Tasks are pickled and queued in order: a filter function must reach the broker before its digest
+        self._send_lock = threading.Lock()
+        self._sent_codes: set[str] = set()
+        self._replies: dict[int, bytes] = {}
+        # Tasks waiting for their result, sent again if the broker misses a function
+        self._tasks: dict[int, tuple] = {}
+        self._request_ids = count()
+        self._client_id = f"{os.getpid()}-{uuid.uuid4().hex}"
+        self._receiver, self._sender = Pipe(duplex=False)
+        threading.Thread(target=self._read_replies, args=(self._receiver,), daemon=True).start()
+        self.queue.put((REGISTER, self._client_id, self._sender))
+        self._pid = os.getpid()
+
+
+    def submit(self, *task) -> int:
+        """
+        Sends a task to the broker without waiting for its result, so that many
+        tasks can be pipelined before collecting their results with result().
+
+        Args:
+            *task: The FilterBroker method to call followed by its arguments.
+
+        Returns:
+            int: The request id of the task.
+        """
+        if self._pid != os.getpid():
+            with _connect_lock:
+                if self._pid != os.getpid():
+                    self._connect()
+        method, *args = task
+        with self._send_lock:
+            pickled_task = (dump_method(method), FilterCode.dumps(args, self._sent_codes))
+            request_id = next(self._request_ids)
+            self._tasks[request_id] = task
+            self.queue.put((self._client_id, request_id, *pickled_task))
+        return request_id
+
+
+    def _read_replies(self, receiver) -> None:
+        """
+        Runs in the reader thread: stores the replies until the broker closes the pipe.
+        """
+        while True:
+            try:
+                reply_id, response = receiver.recv()
+            except (EOFError, OSError):
+                return
+            with self._condition:
+                self._replies[reply_id] = response
+                self._condition.notify_all()
+
+
+    def _receive(self, request_id: int) -> bytes:
+        """
+        Waits for the raw reply of a request.
+
+        Args:
+            request_id (int): The request id returned by submit.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: request_id in self._replies)
+            return self._replies.pop(request_id)
+
+
+    def result(self, request_id: int):
+        """
+        Waits for the result of a task sent with submit. Each result can be
+        collected once, by any thread of the process.
+
+        Args:
+            request_id (int): The request id returned by submit.
+
+        Returns:
+            The result of the method, None if it raised an exception.
+        """
+        result = self._receive(request_id)
+        task = self._tasks.pop(request_id)
+        if type(result) is tuple and result[0] == UNKNOWN_CODE:
+            # The function was evicted from the broker with its filter: send it by value
+            with self._send_lock:
+                self._sent_codes.discard(result[1])
+            return self.result(self.submit(*task))
         if result:
-            result = dill.loads(result)
-        return result
\ No newline at end of file
+            result = FilterCode.loads(result)
+        return result
+
+
+    def ask(self, *task):
+        """
+        Sends a task to the broker and waits for its result.
+
+        Args:
+            *task: The FilterBroker method to call followed by its arguments.
+
+        Returns:
+            The result of the method, None if it raised an exception.
+        """
+        return self.result(self.submit(*task))
+
+
+    def ask_batch(self, operations: list[tuple]) -> list:
+        """
+        Executes several tasks atomically with a single round trip, see FilterBroker.batch.
+
+        Args:
+            operations (list[tuple]): The tasks, each a FilterBroker method followed by its arguments.
+
+        Returns:
+            list: The results of the tasks, None if a task raised an exception and the batch was rolled back.
+        """
+        from .FilterBroker import FilterBroker
+        return self.ask(FilterBroker.batch, operations)
+
@@ -0,0 +1,229 @@
+import hashlib
+import io
+import pickle
+import threading
+import weakref
+from types import CodeType, FunctionType
+import dill
+
+# Tag of the pickled references to a filter function
+PERSISTENT_TAG = "filter_code"
+
+
+class UnknownCode(KeyError):
+    """
+    Raised when a digest is received whose function is not in the cache of the
+    process, because its filter was removed: the sender must send it again.
+    """
+    def __init__(self, digest: str) -> None:
+        super().__init__(digest)
+        self.digest = digest
+
+
+def _cell_contents(cell):
+    try:
+        return cell.cell_contents
+    except ValueError:
+        # Empty cell
+        return None
+
+
+def _update_with_code(digest, code: CodeType) -> None:
+    digest.update(code.co_code)
+    digest.update(repr((code.co_name, code.co_names, code.co_varnames, code.co_freevars, code.co_cellvars)).encode())
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            _update_with_code(digest, const)
+        elif isinstance(const, frozenset):
+            # The iteration order of a frozenset changes with the hash seed
+            digest.update(repr(sorted(map(repr, const))).encode())
+        else:
+            digest.update(repr(const).encode())
+        digest.update(b"\0")
+
+
+class FilterCodeCache:
+    """
+    Filter functions of the process, by digest of their code.
+
+    A filter function is serialized by value only the first time it is sent
+    to another process: after that only its digest is sent, and the receiver
+    takes the function from its own cache. The same code is deserialized once
+    per process, whatever the number of Filter objects and messages using it.
+
+    Attributes:
+        functions (dict[str, FunctionType]): The filter functions by digest.
+    """
+
+    def __init__(self) -> None:
+        self.functions: dict[str, FunctionType] = {}
+        # Weak keys: a function that dies takes its digest with it, even if its id is reused
+        self._digests: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def digest(function: FunctionType) -> str:
+        """
+        Computes the content digest of a filter function: its code, including
+        the nested functions, its defaults and its closure. The serialization
+        of dill can't be used, it refers to importable functions by name, so it
+        doesn't change with their code.
+
+        Args:
+            function (FunctionType): The filter function.
+
+        Returns:
+            str: The SHA-256 digest of the function.
+        """
+        if type(function) is not FunctionType:
+            return hashlib.sha256(dill.dumps(function)).hexdigest()
+        # The same code in two namespaces reads different globals
+        digest = hashlib.sha256(f"{function.__module__}.{function.__qualname__}:{id(function.__globals__)}".encode())
+        _update_with_code(digest, function.__code__)
+        state = (function.__defaults__, function.__kwdefaults__,
+                 tuple(_cell_contents(cell) for cell in function.__closure__ or ()))
+        try:
+            digest.update(dill.dumps(state))
+        except Exception:
+            digest.update(repr(state).encode())
+        return digest.hexdigest()
+
+
+    def register(self, function: FunctionType, digest: str = None) -> tuple[FunctionType, str]:
+        """
+        Adds a filter function to the cache.
+
+        Args:
+            function (FunctionType): The filter function.
+            digest (str, optional): The digest of the function, computed if not provided.
+
+        Returns:
+            tuple[FunctionType, str]: The cached function with the same digest, and the digest.
+        """
+        digest = digest or self.digest(function)
+        with self._lock:
+            cached = self.functions.setdefault(digest, function)
+            if type(cached) is FunctionType:
+                self._digests[cached] = digest
+        return cached, digest
+
+
+    def digest_of(self, function) -> str:
+        """
+        Returns the digest of a registered filter function, None if it is not registered.
+        """
+        return self._digests.get(function)
+
+
+    def get(self, digest: str) -> FunctionType:
+        """
+        Returns the cached filter function with the given digest.
+
+        Raises:
+            UnknownCode: If no function with the given digest is cached.
+        """
+        try:
+            return self.functions[digest]
+        except KeyError:
+            raise UnknownCode(digest) from None
+
+
+    def evict(self, digest: str) -> None:
+        """
+        Drops a filter function from the cache, when no filter uses it anymore.
+        """
+        with self._lock:
+            self.functions.pop(digest, None)
+
+
+# Each process has its own cache
+codes = FilterCodeCache()
+
+
+class _NeedsDill(Exception):
+    pass
+
+
+class _FastPickler(pickle.Pickler):
+    """
+    C pickler for the objects whose functions are all filter functions already
+    sent through the channel, the common case.
+    """
+    def __init__(self, file, known: set[str]):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.known = known
+
+    def persistent_id(self, obj):
+        if type(obj) is not FunctionType:
+            return None
+        digest = codes.digest_of(obj)
+        if digest is None or digest not in self.known:
+            # dill serializes it by value
+            raise _NeedsDill()
+        return (PERSISTENT_TAG, digest)
+
+
+class _Pickler(dill.Pickler):
+    def __init__(self, file, known: set[str]):
+        super().__init__(file)
+        self.known = known
+        self.sent: set[str] = set()
+
+    def persistent_id(self, obj):
+        if type(obj) is not FunctionType:
+            return None
+        digest = codes.digest_of(obj)
+        if digest is None:
+            return None
+        if digest in self.known or digest in self.sent:
+            return (PERSISTENT_TAG, digest)
+        self.sent.add(digest)
+        return None
+
+
+class _Unpickler(dill.Unpickler):
+    def persistent_load(self, pid):
+        tag, digest = pid
+        if tag != PERSISTENT_TAG:
+            raise dill.UnpicklingError(f"Unknown persistent id {tag}")
+        return codes.get(digest)
+
+
+def dumps(obj, known: set[str]) -> bytes:
+    """
+    Serializes an object with dill, replacing the filter functions already sent
+    through the channel by their digest.
+
+    Args:
+        obj: The object to serialize.
+        known (set[str]): The digests already sent through the channel, updated
+            with the digests of the functions serialized by value.
+
+    Returns:
+        bytes: The serialized object.
+    """
+    file = io.BytesIO()
+    try:
+        _FastPickler(file, known).dump(obj)
+        return file.getvalue()
+    except (_NeedsDill, pickle.PicklingError, AttributeError, TypeError):
+        file = io.BytesIO()
+    pickler = _Pickler(file, known)
+    pickler.dump(obj)
+    known.update(pickler.sent)
+    return file.getvalue()
+
+
+def loads(data: bytes):
+    """
+    Deserializes an object serialized by dumps, taking the filter functions
+    sent by digest from the cache of the process.
+
+    Args:
+        data (bytes): The serialized object.
+
+    Returns:
+        The deserialized object.
+    """
+    return _Unpickler(io.BytesIO(data)).load()
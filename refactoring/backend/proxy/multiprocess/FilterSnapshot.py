@@ -0,0 +1,36 @@
+from dataclasses import dataclass
+from .Filter import Filter
+from ..service import Service
+
+@dataclass(frozen=True)
+class FilterSnapshot:
+    """
+    Immutable list of the filters subscribed by a service, published by the
+    FilterBroker. Service processes keep the snapshot and ask for a new one
+    only when the generation of the broker changes.
+
+    Attributes:
+        version (int): The broker generation the snapshot was taken at.
+        service (Service): The service the filters are subscribed by.
+        filters (tuple[tuple[str, Filter], ...]): The names and filters, in evaluation order.
+    """
+
+    version: int
+    service: Service = None
+    filters: tuple[tuple[str, Filter], ...] = ()
+
+
+    def execute(self, stream) -> str:
+        """
+        Applies the filters to the stream, in order.
+
+        Args:
+            stream (Stream): The stream of the connection.
+
+        Returns:
+            str: The name of the first filter returning True, None if no filter does.
+        """
+        for name, filter in self.filters:
+            if filter(self.service, stream):
+                return name
+        return None
@@ -1,5 +1,7 @@
 from .shared import namespace
 from .shared import asker
+from .shared import broker
 from .shared import service_manager
 from .FilterBrokerAsker import FilterBrokerAsker
-from .FilterBroker import FilterBroker
\ No newline at end of file
+from .FilterBroker import FilterBroker
+from .FilterSnapshot import FilterSnapshot
\ No newline at end of file
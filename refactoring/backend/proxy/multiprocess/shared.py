@@ -1,4 +1,4 @@
-from multiprocessing import Manager
+from multiprocessing import Manager, SimpleQueue
 from .FilterBroker import FilterBroker
 from .FilterBrokerAsker import FilterBrokerAsker
 from ..service.ServiceManager import ServiceManager
@@ -10,6 +10,7 @@ namespace = manager.Namespace()
 # modifies the configuration of the services
 namespace.service_lock = manager.Lock()
 
-broker = FilterBroker(manager.Queue())
-asker = FilterBrokerAsker(broker.queue)
+# A plain queue: a manager queue would add a round trip to the manager process to every task
+broker = FilterBroker(SimpleQueue())
+asker = FilterBrokerAsker(broker.queue, broker.generation)
 service_manager = ServiceManager(asker, manager.dict())
\ No newline at end of file
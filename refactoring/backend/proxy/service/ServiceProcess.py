@@ -2,6 +2,8 @@ from multiprocessing import Process, Value
 from .ServiceClass import Service
 from .stream import HTTPStream, TCPStream
 from ..multiprocess import FilterBrokerAsker
+from ..multiprocess.FilterBroker import FilterBroker
+from ..multiprocess.FilterSnapshot import FilterSnapshot
 from ..utils import block_packet, filter_packet, receive_from, start_tls, enable_ssl
 from ..configuration.constants import HOST
 import socket
@@ -19,6 +21,8 @@ class ServiceProcess(Process):
         super().__init__()
         self.service : Service = service
         self.asker : FilterBrokerAsker = asker
+        # Filters subscribed by the service, replaced when the broker publishes a new generation
+        self.snapshot : FilterSnapshot = FilterSnapshot(-1, service)
 
     @staticmethod
     def __get_address_family__(host : str = "::"):
@@ -34,7 +38,24 @@ class ServiceProcess(Process):
             f.write(f"Received signal {signum} in process {os.getpid()}\n")
         sys.exit(0)
     
+    def get_filters(self) -> FilterSnapshot:
+        """
+        Returns the snapshot of the filters subscribed by the service. The broker
+        is asked for a new snapshot only when its generation has changed, so
+        most messages are filtered without any IPC.
+        """
+        snapshot = self.snapshot
+        generation = self.asker.generation
+        if generation is not None and snapshot.version == generation.value:
+            return snapshot
+        with self.snapshot_lock:
+            # Another connection may have fetched it in the meantime
+            if self.snapshot is snapshot:
+                self.snapshot = self.asker.ask(FilterBroker.get_snapshot, self.service) or snapshot
+            return self.snapshot
+
     def run(self):
+        self.snapshot_lock = threading.Lock()
         # this is the socket we will listen on for incoming connections
         proxy_socket = socket.socket(ServiceProcess.__get_address_family__(), socket.SOCK_STREAM)
         proxy_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -129,7 +150,7 @@ class ServiceProcess(Process):
                         connection_open = False
                         break
 
-                    attack = filter_packet(stream, None)
+                    attack = filter_packet(stream, self.get_filters())
                     if not attack:
                         remote_socket.send(stream.current_message)
                 else:
@@ -140,7 +161,7 @@ class ServiceProcess(Process):
                         connection_open = False
                         break
 
-                    attack = filter_packet(stream, None)
+                    attack = filter_packet(stream, self.get_filters())
                     if not attack:
                         local_socket.send(stream.current_message)
 
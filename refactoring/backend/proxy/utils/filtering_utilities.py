@@ -78,7 +78,7 @@ def block_packet(local_socket: socket.socket, socket_family, remote_socket, bloc
             local_socket.detach(), socket_family, socket.SOCK_STREAM)
 
     local_socket.send(block_answer.encode())
-    if dos.get("enabled"):
+    if dos and dos.get("enabled"):
         start = time.time()
         try:
             while time.time() - start < dos["duration"]:
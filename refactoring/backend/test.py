@@ -2,7 +2,7 @@ from proxy.service import Service
 from proxy.multiprocess.FilterBroker import FilterBroker
 from proxy.multiprocess.FilterBrokerAsker import FilterBrokerAsker
 from proxy.multiprocess.Filter import Filter
-from multiprocessing import Manager
+from multiprocessing import SimpleQueue
 from multiprocessing import Process
 
 
@@ -16,13 +16,13 @@ def add_filter(asker : FilterBrokerAsker):
 
 
 def subscribe(asker : FilterBrokerAsker):
-    service = Service(name='test service', port=8080, type='http')
+    service = Service(name='test service', port=8080, type='http', active=True)
     asker.ask(FilterBroker.subscribe_service, service, 'test')
 
 
 
 def get_filter(asker : FilterBrokerAsker):
-    service = Service(name='test service', port=8080, type='http')
+    service = Service(name='test service', port=8080, type='http', active=True)
     import time
     start = time.time()
     
@@ -33,9 +33,8 @@ def get_filter(asker : FilterBrokerAsker):
 
 
 if __name__ == "__main__":
-    manager = Manager()
-    broker = FilterBroker(manager.Queue())
-    asker = FilterBrokerAsker(broker.queue)
+    broker = FilterBroker(SimpleQueue())
+    asker = FilterBrokerAsker(broker.queue, broker.generation)
     broker.start()
 
     add_filter_process = Process(target=add_filter, args=(asker,))
@@ -1,7 +1,7 @@
 from proxy.service import ServiceManager
 from proxy.service import Service
 from proxy.multiprocess import FilterBrokerAsker, FilterBroker, Filter
-from multiprocessing import Manager
+from multiprocessing import SimpleQueue
 import time
 import logging
 logging.basicConfig(level=logging.INFO)
@@ -12,8 +12,8 @@ if __name__ == "__main__":
         logging.info("This is a filter function")
         return x + y
     
-    fb : FilterBroker = FilterBroker(Manager().Queue())
-    fba : FilterBrokerAsker = FilterBrokerAsker(fb.queue)
+    fb : FilterBroker = FilterBroker(SimpleQueue())
+    fba : FilterBrokerAsker = FilterBrokerAsker(fb.queue, fb.generation)
     sm : ServiceManager = ServiceManager(fba)
     filter : Filter.Filter = Filter.Filter(filter_function)
     fb.start()